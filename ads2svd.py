@@ -9,112 +9,2636 @@ import glob
 import copy
 import re
 import argparse
+import hashlib
+import json
+import datetime
+import decimal
+import math
+import select
+import multiprocessing
+import urllib.parse
+import time
+import mmap
+import ctypes
+import ctypes.util
+import struct
+import array
+import resource
+import gzip
+import threading
+import concurrent.futures
+import collections
+import itertools
+import http.server
 
 rawparser = etree.XMLParser(remove_blank_text=True)
-xmlparser=None
-config={}
-
-def update_config(args):    
-    global config
-    config["configdb_path"]= os.path.abspath(os.path.expanduser(args.configdb))
-    config["configdb_cores_path"]=  os.path.join(config["configdb_path"], "Cores/")
-    config["configdb_schemas_path"]= os.path.join(config["configdb_path"], "Schemas/")
-    config["out_dir"] =   os.path.normpath(args.out)
-    config["xinclude_error_log"] = os.path.join(config["out_dir"], 'xinclude_error.log')
-    if not os.path.isdir(config["out_dir"]):
-        os.mkdir(config["out_dir"])
-
-    if os.path.isfile(config["xinclude_error_log"]):
-        error_log = open(config["xinclude_error_log"],"w+")
-        error_log.close()
 
+XINCLUDE_NS = 'http://www.w3.org/2001/XInclude'
+XML_BASE = '{http://www.w3.org/XML/1998/namespace}base'
+xpointer_part = re.compile(r'\s*(\w+)\(((?:[^()^]|\^.|\((?:[^()^]|\^.)*\))*)\)')
+
+class IncludeError(Exception):
+    pass
 
+def config_from_args(args):
+    cfg = {}
+    cfg["configdb_path"]= os.path.abspath(os.path.expanduser(args.configdb))
+    cfg["configdb_cores_path"]=  os.path.join(cfg["configdb_path"], "Cores/")
+    cfg["configdb_schemas_path"]= os.path.join(cfg["configdb_path"], "Schemas/")
+    cfg["out_dir"] =   os.path.normpath(args.out)
+    cfg["xinclude_error_log"] = os.path.join(cfg["out_dir"], 'xinclude_error.log')
+    cfg["manifest"] = os.path.join(cfg["out_dir"], 'manifest.json')
+    cfg["jobs"] = args.jobs if args.jobs != 0 else os.cpu_count()
+    cfg["only_stale"] = args.stale
+    cfg["svd"] = args.svd or bool(args.check)
+    cfg["stats"] = args.stats
+    cfg["snapshot"] = args.snapshot
+    cfg["index"] = args.index
+    cfg["header"] = args.header
+    cfg["json"] = args.json
+    cfg["export"] = args.export or []
+    cfg["derive"] = args.derive
+    cfg["watch"] = args.watch
+    cfg["shard"] = args.shard
+    cfg["costs"] = args.costs
+    cfg["index_file"] = os.path.join(cfg["out_dir"], 'registers.idx')
+    cfg["hash_file"] = os.path.join(cfg["out_dir"], 'registers.hash')
+    cfg["validate"] = args.validate
+    cfg["store"] = args.store
+    cfg["max_memory"] = args.max_memory
+    cfg["repair"] = args.repair
+    cfg["repair_log"] = os.path.join(cfg["out_dir"], 'include_repairs.log')
+    cfg["store_file"] = os.path.join(cfg["out_dir"], 'store.json')
+    cfg["validated"] = os.path.join(cfg["out_dir"], 'validated.json')
+    cfg["validation_log"] = os.path.join(cfg["out_dir"], 'validation.log')
+    return cfg
 
+def prepare_out(resolver):
+    if not os.path.isdir(resolver.config["out_dir"]):
+        os.mkdir(resolver.config["out_dir"])
+
+    if os.path.isfile(resolver.config["xinclude_error_log"]):
+        error_log = open(resolver.config["xinclude_error_log"],"w+")
+        error_log.close()
 
-def build_schema_wrapper():
-    global xmlparser    
+def build_schema_wrapper(resolver):
     breaking = { 'os_extension.xsd' : 1 }
     ws = '<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="">'+"\n" 
-    for s in glob.glob(  os.path.join(config["configdb_schemas_path"] , "*.xsd")):        
+    for s in glob.glob(  os.path.join(resolver.config["configdb_schemas_path"] , "*.xsd")):        
         if(s.split(os.path.sep)[-1] in breaking):
             continue
-        sch = etree.parse(s,rawparser)
+        sch = etree.parse(s,resolver.parser)
         tns = sch.xpath('/xs:schema',namespaces={'xs': 'http://www.w3.org/2001/XMLSchema'})[0].get("targetNamespace")   
         if(tns):
             ws += '<xs:import'+"\n"
             ws += 'namespace="' + tns + '"'+ "\n"
             ws+= 'schemaLocation="file://' + s + '"' + "\n/>\n"        
     ws +="</xs:schema>"
-    s  = etree.XMLSchema(etree.XML(ws))
-    xmlparser = etree.XMLParser(remove_blank_text=True,schema =  s)
+    resolver.schema = etree.XMLSchema(etree.XML(ws))
 
-def loadxml(p):
+def get_schema(resolver):
+    # only built when something is validated
+    if resolver.schema is None:
+        build_schema_wrapper(resolver)
+    return resolver.schema
 
-    print(p)
+def schema_hash(resolver):
+    # the validation cache is only good for the schemas it was made with
+    h = hashlib.sha1()
+    for s in sorted(glob.glob(os.path.join(resolver.config["configdb_schemas_path"], "*.xsd"))):
+        h.update(('%s %s\n' % (s.split(os.path.sep)[-1], file_hash(resolver, s))).encode())
+    return h.hexdigest()
+
+def schema_errors(resolver, doc):
+    s = get_schema(resolver)
+    if s.validate(doc):
+        return []
+    return [(e.line, e.path, e.message) for e in s.error_log]
+
+def validate_source(resolver, path, doc):
+    h = file_hash(resolver, path)
+    if h not in resolver.validated:
+        resolver.validated[h] = schema_errors(resolver, doc)
+    return resolver.validated[h]
+
+def invalid_lines(resolver, path, errs):
+    return ['INVALID;file="%s";line=%d;path="%s";msg="%s"\n' % (path[len(resolver.config["configdb_path"]):], line, epath, msg) for line, epath, msg in errs]
+
+def include_selector(resolver, path, xpointer):
+    key = (path, xpointer)
+    if key not in resolver.include_selectors:
+        ns = {}
+        expr = None
+        pos = 0
+        for m in xpointer_part.finditer(xpointer):
+            if m.start() != pos:
+                break
+            pos = m.end()
+            scheme, data = m.group(1), re.sub(r'\^(.)', r'\1', m.group(2))
+            if scheme == 'xmlns':
+                prefix, uri = data.split('=', 1)
+                ns[prefix.strip()] = uri.strip()
+            elif scheme == 'xpointer':
+                expr = data
+        if pos != len(xpointer.rstrip()) or expr is None:
+            # shorthand and element() pointers are left to libxml2
+            resolver.include_selectors[key] = None
+        else:
+            try:
+                resolver.include_selectors[key] = etree.XPath(expr, namespaces=ns)
+            except etree.XPathError as err:
+                # a failed include like any other, not the end of the run
+                raise IncludeError("could not compile XPointer #%s : %s" % (xpointer, err))
+    return resolver.include_selectors[key]
+
+def include_doc(resolver, path):
+    if path not in resolver.include_docs:
+        resolver.include_deps[path] = set()
+        resolver.include_docs[path] = None
+        try:
+            doc = etree.parse(path, resolver.parser)
+        except (OSError, etree.XMLSyntaxError) as err:
+            del resolver.include_docs[path]
+            if resolver.config.get("repair"):
+                raise IncludeError("could not load %s, and no fallback was found : %s" % (path, err))
+            raise IncludeError("could not load %s : %s" % (path, err))
+        if resolver.config.get("validate") == "once":
+            validate_source(resolver, path, doc)
+        curr_path = os.path.dirname(path)
+        deps = resolver.include_deps[path]
+        try:
+            for el in list(doc.iter('{%s}include' % XINCLUDE_NS)):
+                resolve_include(resolver, el, curr_path, deps)
+        except (lxml.etree.XIncludeError, IncludeError):
+            del resolver.include_docs[path]
+            raise
+        resolver.include_docs[path] = doc
+    elif resolver.include_docs[path] is None:
+        raise IncludeError("detected a recursion in %s" % path)
+    return resolver.include_docs[path]
+
+def include_nodes(resolver, path, xpointer):
+    key = (path, xpointer)
+    if key in resolver.include_failures:
+        raise IncludeError(resolver.include_failures[key])
+    if key not in resolver.include_results:
+        try:
+            resolver.include_results[key] = select_nodes(resolver, path, xpointer)
+        except (lxml.etree.XIncludeError, IncludeError) as err:
+            if resolver.config.get("repair") and not os.path.exists(path) and relocate(resolver, path, xpointer):
+                return resolver.include_results[key]
+            # not while the file is being resolved : that is a recursion, not a bad include
+            if resolver.include_docs.get(path, False) is not None:
+                resolver.include_failures[key] = str(err)
+            raise
+    return resolver.include_results[key]
+
+def index_configdb(resolver):
+    if resolver.configdb_files is None:
+        resolver.configdb_files = {}
+        for top, dirs, files in os.walk(resolver.config["configdb_path"]):
+            dirs.sort()
+            for name in sorted(files):
+                stem, ext = os.path.splitext(name.lower())
+                resolver.configdb_files.setdefault(name.lower(), []).append(os.path.join(top, name))
+                if ext in ('.xml', '.inc'):
+                    resolver.configdb_files.setdefault(stem, []).append(os.path.join(top, name))
+    return resolver.configdb_files
+
+def relocation_candidates(resolver, path):
+    # the files with the same name (any case), then with the other extension
+    # (.xml / .inc), those sharing the most of the href path and directory first
+    name = os.path.basename(path).lower()
+    files = index_configdb(resolver)
+    cands = list(files.get(name, []))
+    cands += [f for f in files.get(os.path.splitext(name)[0], []) if f not in cands]
+    parts = path.lower().split(os.path.sep)
+    def rank(f):
+        fparts = f.lower().split(os.path.sep)
+        tail = 0
+        while tail < min(len(parts), len(fparts)) and parts[-1 - tail] == fparts[-1 - tail]:
+            tail += 1
+        head = len(os.path.commonprefix([parts[:-1], fparts[:-1]]))
+        return (-(os.path.basename(f).lower() == name), -tail, -head, f)
+    return sorted((f for f in cands if f != path), key=rank)
+
+def relocate(resolver, path, xpointer):
+    # --repair : a missing include target, the first file of the configdb that
+    # gives some nodes for the xpointer stands in for it
+    for cand in relocation_candidates(resolver, path):
+        try:
+            nodes = include_nodes(resolver, cand, xpointer)
+        except (lxml.etree.XIncludeError, IncludeError):
+            continue
+        if nodes:
+            resolver.include_results[(path, xpointer)] = nodes
+            resolver.include_repairs[(path, xpointer)] = cand
+            resolver.new_repairs.append((path, cand))
+            return cand
+    return None
+
+def select_nodes(resolver, path, xpointer):
+    doc = include_doc(resolver, path)
+    if xpointer is None:
+        nodes = [doc.getroot()]
+    else:
+        try:
+            nodes = include_selector(resolver, path, xpointer)(doc)
+        except etree.XPathError as err:
+            # undeclared prefix, unknown function...
+            raise IncludeError("could not evaluate XPointer #%s : %s" % (xpointer, err))
+        if not isinstance(nodes, list):
+            raise IncludeError("XPointer is not a range: #%s" % xpointer)
+        if not all(isinstance(n, etree._Element) and isinstance(n.tag, str) for n in nodes):
+            raise IncludeError("XPointer selects non element nodes: #%s" % xpointer)
+    return nodes
+
+def resolve_include(resolver, el, curr_path, deps):
+    href = el.get("href")
+    xpointer = el.get("xpointer")
+    if href:
+        deps.add(os.path.normpath(os.path.join(curr_path, href)))
+    if (not href or el.get("parse", "xml") != "xml" or len(el)
+            or (xpointer is not None and include_selector(resolver, os.path.normpath(os.path.join(curr_path, href)), xpointer) is None)):
+        # not something the cache knows about, let libxml2 deal with it
+        etree.ElementTree(el).xinclude()
+        return
+    path = os.path.normpath(os.path.join(curr_path, href))
+    nodes = include_nodes(resolver, path, xpointer)
+    if (path, xpointer) in resolver.include_repairs:
+        path = resolver.include_repairs[(path, xpointer)]
+        deps.add(path)
+    # same xml:base fixup as libxml2 : only needed when the target is not a sibling
+    base = os.path.relpath(path, curr_path).replace(os.path.sep, '/')
+    if '/' not in base:
+        base = None
+    pap = el.getparent()
+    idx = pap.index(el)
+    tail = el.tail
+    pap.remove(el)
+    for n in nodes:
+        n = copy.deepcopy(n)
+        if base:
+            n.set(XML_BASE, urllib.parse.urljoin(base, n.get(XML_BASE, '')))
+        pap.insert(idx, n)
+        idx += 1
+    if tail:
+        if idx:
+            pap[idx-1].tail = (pap[idx-1].tail or '') + tail
+        else:
+            pap.text = (pap.text or '') + tail
+
+# python port of ads2svd.xslt (internal:doparse and friends), works on the
+# resolved tree in memory. The stylesheet quirks are kept on purpose so both
+# engines give the same svd (see --check).
+svd_ns = {
+    'c' : 'http://www.arm.com/core_definition',
+    'cr' : 'http://www.arm.com/core_reg',
+    'tcf' : 'http://com.arm.targetconfigurationeditor',
+}
+XSI_NS = 'http://www.w3.org/2001/XMLSchema-instance'
+CR = '{%s}' % svd_ns['cr']
+TCF = '{%s}' % svd_ns['tcf']
+hexlookup = '0123456789ABCDEF'
+bitperbyte = 8
+
+def string_value(node):
+    if isinstance(node, str):
+        return node
+    return ''.join(node.itertext()) if len(node) else node.text or ''
+
+def value_of(items):
+    return ' '.join(map(string_value, items))
+
+def single_value_of(items):
+    if len(items) > 1:
+        raise ValueError("a sequence of more than one item is not allowed : %s" % items[0].tag)
+    return value_of(items)
+
+def xpath_number(s):
+    try:
+        return float(s)
+    except (TypeError, ValueError):
+        return float('nan')
+
+def double_str(d):
+    if d != d:
+        return 'NaN'
+    if d == 0 or 1e-6 <= abs(d) < 1e6:
+        r = repr(d)
+        return r[:-2] if r.endswith('.0') else r
+    sign, digits, exp = decimal.Decimal(repr(d)).normalize().as_tuple()
+    return '%s%d.%sE%d' % ('-' if sign else '', digits[0], ''.join(map(str, digits[1:])) or '0', exp + len(digits) - 1)
+
+def map_access(access):
+    return {'RW' : 'read-write', 'RO' : 'read-only', 'WO' : 'write-only', 'RMW' : 'read-write'}.get(access, '')
+
+def map_cpu_name(cpu_name):
+    if re.search('[Cc]ortex-?[A-Z][0-9]+', cpu_name):
+        return re.sub('(-| )', '_', re.sub(r'\+', 'P', re.sub(r'[Cc]ortex-?([A-Z][0-9]+\+?).*', r'C\1', cpu_name)))
+    return cpu_name
+
+def dec2hex(val):
+    # same digits as internal:lo_num2base, which stops once val <= 16 (16 gives 0x0)
+    digits = []
+    while True:
+        digits.append(math.fmod(val, 16))
+        if not val > 16:
+            break
+        val = math.floor(val / 16)
+    return '0x' + ''.join(hexlookup[int(d)] for d in reversed(digits) if 0 <= d < 16 and d == math.floor(d))
+
+def hex2dec(hexorig):
+    digits = hexorig[2:].upper()
+    if not digits or any(c not in hexlookup for c in digits):
+        raise ValueError("cannot convert %s to a number" % hexorig)
+    return int(digits, 16)
+
+def sort_number(s):
+    n = xpath_number(s)
+    return (0, 0) if n != n else (1, n)
+
+def definition_for(definitions):
+    node = single_value_of(definitions)
+    defs = []
+    if not definitions:
+        return defs
+    for tok in re.split(r'\[|\]', node):
+        if not tok:
+            continue
+        if ':' in tok:
+            vals = sorted(tok.split(':'), key=sort_number)
+            defs.append((vals[0], double_str(xpath_number(vals[1]) - xpath_number(vals[0]) + 1)))
+        else:
+            defs.append((node[1:len(node)-1], '1'))
+    return defs
+
+def max_byte_width(rlists):
+    sizes = [r.get('size') for rlist in rlists for r in rlist.findall(CR + 'register') if r.get('size') is not None]
+    if not sizes:
+        return None
+    return sorted(sizes, key=sort_number, reverse=True)[0] if any(x != x for x in map(xpath_number, sizes)) else max(sizes, key=xpath_number)
+
+def enum_index(enums):
+    # $enums[@name=$enumid] once per register list instead of once per field
+    index = {}
+    for e in enums:
+        if e.get('name') is not None:
+            index.setdefault(e.get('name'), []).append(e)
+    return index
+
+def parse_corereg(reg, pbase, enums):
+    register = etree.Element('register')
+    gui_name = single_value_of(reg.findall(CR + 'gui_name'))
+    etree.SubElement(register, 'name').text = gui_name if 0 < len(gui_name) < 10 else reg.get('name', '')
+    if reg.get('size') is None:
+        raise ValueError("register %s has no size" % reg.get('name'))
+    etree.SubElement(register, 'size').text = dec2hex(float(reg.get('size')) * bitperbyte)
+    etree.SubElement(register, 'access').text = map_access(reg.get('access'))
+    if reg.get('offset') is not None:
+        if pbase is not None:
+            etree.SubElement(register, 'addressOffset').text = dec2hex(hex2dec(reg.get('offset')) - hex2dec(pbase))
+        else:
+            etree.SubElement(register, 'addressOffset').text = reg.get('offset')
+    fields = etree.SubElement(register, 'fields')
+    for bf in reg.findall(CR + 'bitField'):
+        enumid = bf.get('enumerationId', '')
+        for pos, (bitoffset, bitwidth) in enumerate(definition_for(bf.findall(CR + 'definition'))):
+            field = etree.SubElement(fields, 'field')
+            etree.SubElement(field, 'name').text = bf.get('name', '') if pos == 0 else '%s_%d' % (bf.get('name', ''), pos)
+            description = single_value_of(bf.findall(CR + 'description'))
+            etree.SubElement(field, 'description').text = description if len(description) < 10 else bf.get('name', '')
+            etree.SubElement(field, 'bitOffset').text = bitoffset
+            etree.SubElement(field, 'bitWidth').text = bitwidth
+            if bf.get('enumerationId') is not None:
+                enumerated = etree.SubElement(field, 'enumeratedValues')
+                matches = enums.get(enumid, [])
+                items = [i for e in matches for i in e.findall(TCF + 'enumItem')]
+                if items:
+                    values = [(i.get('name', ''), i.get('number', '')) for i in items]
+                else:
+                    enumval = matches[0].get('values', '') if matches else ''
+                    values = []
+                    for tok in (enumval.split(',') if enumval else []):
+                        enumitem = tok.split('=') if tok else []
+                        values.append((enumitem[0] if enumitem else '', enumitem[1] if len(enumitem) > 1 else ''))
+                for name, value in values:
+                    enumeratedvalue = etree.SubElement(enumerated, 'enumeratedValue')
+                    etree.SubElement(enumeratedvalue, 'name').text = name
+                    etree.SubElement(enumeratedvalue, 'value').text = value
+    return register
+
+# the peripherals are yielded with an empty <registers> as their last child and
+# the registers to put in it, built one at a time : doparse fills them in, write_device
+# writes each register as it comes
+def parse_reglist(rlist):
+    enums = enum_index(rlist.findall(TCF + 'enumeration'))
+    peripheral = etree.Element('peripheral')
+    etree.SubElement(peripheral, 'name').text = rlist.get('name', '')
+    etree.SubElement(peripheral, 'description').text = rlist.get('name', '') + ', the registers are not accessed by address'
+    etree.SubElement(peripheral, 'registers')
+    return peripheral, (parse_corereg(reg, None, enums) for reg in rlist.xpath(".//cr:register[not(contains(./cr:gui_name,'_'))]", namespaces=svd_ns))
+
+def parse_reglists(rlists):
+    for rlist in rlists:
+        if next(rlist.iter(CR + 'peripheral'), None) is None:
+            yield parse_reglist(rlist)
+
+def reglists_by_filter(doc):
+    # one walk for all the reg_filter outputs, the None entry holds every list
+    groups = {None : []}
+    for rlist in doc.iter(CR + 'register_list'):
+        groups[None].append(rlist)
+        if rlist.get('filter') is not None:
+            groups.setdefault(rlist.get('filter'), []).append(rlist)
+    return groups
+
+def doparse(doc, rlists):
+    device = device_head(doc, rlists)
+    peripherals = device.find('peripherals')
+    for peripheral, registers in device_peripherals(doc, rlists):
+        peripheral.find('registers').extend(registers)
+        peripherals.append(peripheral)
+    return device
+
+def device_head(doc, rlists):
+    # the device with an empty <peripherals>
+    core = doc.getroot()
+    has = lambda path: bool(core.xpath(path, namespaces=svd_ns))
+    name = value_of(core.findall('c:name', svd_ns))
+    device = etree.Element('device', nsmap={'xs' : XSI_NS})
+    device.set('schemaVersion', '1.3')
+    device.set('{%s}noNamespaceSchemaLocation' % XSI_NS, 'https://raw.githubusercontent.com/ARM-software/CMSIS_5/develop/CMSIS/Utilities/CMSIS-SVD.xsd')
+    etree.SubElement(device, 'vendor').text = 'ARM Ltd.'
+    etree.SubElement(device, 'vendorID').text = 'ARM'
+    etree.SubElement(device, 'name').text = re.sub(r'[ \-]', '_', name)
+    etree.SubElement(device, 'series').text = value_of(core.findall('c:series', svd_ns))
+    etree.SubElement(device, 'version').text = datetime.datetime.now(datetime.timezone.utc).isoformat().replace('+00:00', 'Z')
+    etree.SubElement(device, 'description').text = name + ' core descriptions, generated from ARM Development studio'
+    cpu = etree.SubElement(device, 'cpu')
+    etree.SubElement(cpu, 'name').text = map_cpu_name(name)
+    etree.SubElement(cpu, 'revision').text = 'r0p0'
+    etree.SubElement(cpu, 'endian').text = 'little'
+    flags = [
+        ('mpuPresent', has("cr:peripheral[@name='MPU']")),
+        ('fpuPresent', has("cr:register[@name='FPCCR'] | c:peripheral[@name='FPU'] | cr:register[@name='MVFR0']")),
+        ('fpuDP', core.get('name') == 'FPDP'),
+        ('dspPresent', core.get('name') == 'SIMDSP'),
+        ('icachePresent', 'ICACHE' in core.get('name', '') or has("c:cache_awareness/@class[contains(.,'ICache')]")),
+        ('dcachePresent', 'DCACHE' in core.get('name', '') or has("c:cache_awareness/@class[contains(.,'DCache')]")),
+        ('itcmPresent', has("cr:register[@name='ITCMR']")),
+        ('dtcmPresent', has("cr:register[@name='DTCMR']")),
+        ('vtorPresent', has("cr:register[@name='VTOR']")),
+    ]
+    for flag, present in flags:
+        if present:
+            etree.SubElement(cpu, flag).text = 'true'
+    etree.SubElement(cpu, 'nvicPrioBits').text = '8'
+    etree.SubElement(cpu, 'vendorSystickConfig').text = 'true'
+    etree.SubElement(device, 'addressUnitBits').text = '8'
+    width = max_byte_width(rlists)
+    etree.SubElement(device, 'width').text = double_str(float(width) * bitperbyte) if width is not None else ''
+    etree.SubElement(device, 'peripherals')
+    return device
+
+def device_peripherals(doc, rlists):
+    for item in parse_reglists(rlists):
+        yield item
+    enum_indexes = {}
+    for p in doc.xpath('//cr:peripheral', namespaces=svd_ns):
+        if p.getparent() not in enum_indexes:
+            enum_indexes[p.getparent()] = enum_index(p.getparent().findall(TCF + 'enumeration'))
+        enums = enum_indexes[p.getparent()]
+        nodes = [n for n in p if isinstance(n.tag, str)]
+        offsets = [n.get('offset') for n in nodes if n.get('offset') is not None]
+        pbase = min(offsets, key=str.lower) if offsets else None
+        peripheral = etree.Element('peripheral')
+        etree.SubElement(peripheral, 'name').text = p.get('name', '')
+        etree.SubElement(peripheral, 'description').text = value_of(p.findall(CR + 'description'))
+        if p.find(CR + 'groupName') is not None:
+            etree.SubElement(peripheral, 'groupName').text = value_of(p.findall(CR + 'groupName'))
+        etree.SubElement(peripheral, 'baseAddress').text = pbase or ''
+        if pbase is None:
+            raise ValueError("peripheral %s has no base address" % p.get('name'))
+        block = etree.SubElement(peripheral, 'addressBlock')
+        etree.SubElement(block, 'offset').text = dec2hex(hex2dec(pbase) - hex2dec(pbase))
+        etree.SubElement(block, 'size').text = dec2hex(8 * sum(float(n.get('size')) for n in nodes if n.get('size') is not None))
+        etree.SubElement(block, 'usage').text = 'registers'
+        etree.SubElement(peripheral, 'registers')
+        yield peripheral, (parse_corereg(reg, pbase, enums) for reg in p.findall(CR + 'register'))
+
+def svd_sources(doc, out_base):
+    # the svd files of a core and the register lists of each, None for the empty one
+    reg_filters = doc.xpath('//c:core_definition/c:reg_filter', namespaces=svd_ns)
+    groups = reglists_by_filter(doc)
+    if not reg_filters:
+        yield out_base + '.svd', groups[None]
+        return
+    # saxon leaves an empty primary output next to the per filter svds
+    yield out_base + '.svd', None
+    for f in reg_filters:
+        yield out_base + '_' + f.get('gui_name', '') + '.svd', groups.get(f.get('id', ''), [])
+
+def svd_outputs(doc, out_base):
+    # one device at a time : it is written and dropped before the next is built
+    for path, rlists in svd_sources(doc, out_base):
+        yield path, doparse(doc, rlists) if rlists is not None else None
+
+# incremental writer : the bytes of ElementTree(doparse(doc, rlists)).write(f,
+# pretty_print=True, xml_declaration=True, encoding='UTF-8'), without ever holding
+# the device, each register is built, written and dropped
+def write_device(f, doc, rlists):
+    device = device_head(doc, rlists)
+    with etree.xmlfile(f, encoding='UTF-8') as xf:
+        xf.write_declaration()
+        with xf.element(device.tag, device.attrib, nsmap=device.nsmap):
+            for el in list(device):
+                # detached, it no longer carries the xmlns:xs of the device
+                device.remove(el)
+                xf.write('\n  ')
+                if el.tag == 'peripherals':
+                    write_streamed(xf, el, 1, write_peripheral, device_peripherals(doc, rlists))
+                else:
+                    write_indented(xf, el, 1)
+            xf.write('\n')
+    f.write(b'\n')
+
+def write_indented(xf, el, level):
+    etree.indent(el, level=level)
+    el.tail = None
+    xf.write(el)
+
+def write_streamed(xf, el, level, write, children):
+    # el has no children yet, they are written as they come
+    first = next(children, None)
+    if first is None:
+        return write_indented(xf, el, level)
+    with xf.element(el.tag, el.attrib):
+        for child in itertools.chain([first], children):
+            xf.write('\n' + '  ' * (level + 1))
+            write(xf, child, level + 1)
+        xf.write('\n' + '  ' * level)
+
+def write_peripheral(xf, item, level):
+    peripheral, registers = item
+    with xf.element(peripheral.tag, peripheral.attrib):
+        for el in peripheral:
+            xf.write('\n' + '  ' * (level + 1))
+            if el.tag == 'registers':
+                write_streamed(xf, el, level + 1, write_indented, registers)
+            else:
+                write_indented(xf, el, level + 1)
+        xf.write('\n' + '  ' * level)
+
+# --derive : identical peripherals, registers and enumeratedValues of a device
+# are written once, the repeats only keep what differs and a derivedFrom
+def svd_key(el, skip):
+    return tuple(etree.tostring(c) for c in el if c.tag not in skip)
+
+def derive_device(device):
+    # derivedFrom is a bare name : the schema has no dotted identifiers, so a
+    # source must be unique where it is looked up (the device for peripherals and
+    # enumeratedValues, its peripheral for registers)
+    def unique(names):
+        seen = collections.Counter(names)
+        return set(n for n, c in seen.items() if c == 1)
+    peripherals = device.find('peripherals')
+    pnames = unique(p.findtext('name') for p in peripherals.findall('peripheral'))
+    first = {}
+    for p in peripherals.findall('peripheral'):
+        key = svd_key(p, ('name', 'description', 'baseAddress'))
+        if key not in first:
+            if p.findtext('name') in pnames:
+                first[key] = p
+            continue
+        for c in list(p):
+            if c.tag not in ('name', 'description', 'baseAddress'):
+                p.remove(c)
+        p.set('derivedFrom', first[key].findtext('name'))
+    sources = [p for p in peripherals.findall('peripheral') if p.get('derivedFrom') is None]
+    # enumeratedValues are named <register>_<field>_values, only used when that is unique in the device
+    enames = unique('%s_%s_values' % (r.findtext('name'), f.findtext('name'))
+                    for p in sources for r in p.findall('registers/register') for f in r.findall('fields/field')
+                    if f.find('enumeratedValues') is not None)
+    first_enum = {}
+    for p in sources:
+        registers = p.findall('registers/register')
+        rnames = unique(r.findtext('name') for r in registers)
+        first = {}
+        for r in registers:
+            fields = r.find('fields')
+            if fields is None or not len(fields):
+                continue
+            key = svd_key(r, ('name', 'addressOffset'))
+            if key in first:
+                for c in list(r):
+                    if c.tag not in ('name', 'addressOffset'):
+                        r.remove(c)
+                r.set('derivedFrom', first[key])
+                continue
+            if r.findtext('name') in rnames:
+                first[key] = r.findtext('name')
+            for f in fields:
+                values = f.find('enumeratedValues')
+                if values is None or not len(values):
+                    continue
+                key = etree.tostring(values)
+                ename = '%s_%s_values' % (r.findtext('name'), f.findtext('name'))
+                if key in first_enum:
+                    values.clear()
+                    values.set('derivedFrom', first_enum[key])
+                elif ename in enames:
+                    name = etree.Element('name')
+                    name.text = ename
+                    values.insert(0, name)
+                    first_enum[key] = ename
+    return device
+
+def write_svds(resolver, doc, out_base):
+    paths = []
+    for path, rlists in svd_sources(doc, out_base):
+        if rlists is None:
+            data = b''
+        elif resolver.config.get("derive"):
+            # what repeats is only known once the whole device is built
+            device = derive_device(doparse(doc, rlists))
+            data = lambda f: etree.ElementTree(device).write(f, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+        else:
+            data = lambda f: write_device(f, doc, rlists)
+        paths.append((path, write_output(resolver, path, data)))
+    return paths
+
+def svd_diff(a, b, path='/device'):
+    if a.tag != b.tag:
+        return '%s : <%s> != <%s>' % (path, a.tag, b.tag)
+    if dict(a.attrib) != dict(b.attrib):
+        return '%s : attributes %s != %s' % (path, dict(a.attrib), dict(b.attrib))
+    if a.tag != 'version' and (a.text or '').strip() != (b.text or '').strip():
+        return '%s : %r != %r' % (path, a.text, b.text)
+    ea = [x for x in a if isinstance(x.tag, str)]
+    eb = [x for x in b if isinstance(x.tag, str)]
+    if len(ea) != len(eb):
+        return '%s : %d children != %d' % (path, len(ea), len(eb))
+    for i, (x, y) in enumerate(zip(ea, eb)):
+        d = svd_diff(x, y, '%s/%s[%d]' % (path, x.tag, i))
+        if d:
+            return d
+    return None
+
+def check_svds(out_dir, xmls_cores, ref_dir):
+    # compare the python emitter output in out_dir with the svds saxon left in ref_dir
+    nbad = 0
+    store = load_store(out_dir)
+    names = output_names(out_dir, store)
+    for x in xmls_cores:
+        core = x.split(os.path.sep)[-1][:-4]
+        for name in names:
+            if not name.endswith('.svd') or (name != core + '.svd' and not name.startswith(core + '_')):
+                continue
+            ref = os.path.join(ref_dir, name)
+            if not os.path.isfile(ref):
+                print('MISSING %s' % ref)
+                nbad += 1
+                continue
+            data = read_output(os.path.join(out_dir, name), store)
+            if not data or os.path.getsize(ref) == 0:
+                diff = None if len(data) == os.path.getsize(ref) else 'one of the files is empty'
+            else:
+                diff = svd_diff(etree.fromstring(data, rawparser), etree.parse(ref, rawparser).getroot())
+            if diff:
+                print('DIFF %s %s' % (name, diff))
+                nbad += 1
+    print('%d svd differences' % nbad)
+    return nbad
+
+# compact model of a resolved core, built once from the tree : numbers and bit
+# ranges are parsed here, names are interned so the cores share their strings
+class Core(object):
+    __slots__ = ('name', 'title', 'series', 'filters', 'register_lists')
+    def __init__(self, name, title, series, filters, register_lists):
+        self.name, self.title, self.series = name, title, series
+        self.filters = filters
+        self.register_lists = register_lists
+
+    def registers(self, reg_filter=None):
+        # reg_filter : gui_name or id, None for every list
+        fid = self.filters.get(reg_filter, reg_filter)
+        for rlist in self.register_lists:
+            if fid is None or rlist.filter in (None, fid):
+                for reg in rlist.registers:
+                    yield reg
+                for p in rlist.peripherals:
+                    for reg in p.registers:
+                        yield reg
+
+class RegisterList(object):
+    __slots__ = ('name', 'filter', 'registers', 'peripherals', 'enumerations')
+    def __init__(self, name, filter, registers, peripherals, enumerations):
+        self.name, self.filter = name, filter
+        self.registers, self.peripherals, self.enumerations = registers, peripherals, enumerations
+
+class Peripheral(object):
+    __slots__ = ('name', 'description', 'group_name', 'base', 'registers')
+    def __init__(self, name, description, group_name, base, registers):
+        self.name, self.description, self.group_name = name, description, group_name
+        self.base, self.registers = base, registers
+
+class Register(object):
+    __slots__ = ('name', 'gui_name', 'description', 'offset', 'size', 'access', 'group', 'fields')
+    def __init__(self, name, gui_name, description, offset, size, access, group, fields):
+        self.name, self.gui_name, self.description = name, gui_name, description
+        # offset : address (None for the registers not accessed by address), size in bytes
+        self.offset, self.size, self.access = offset, size, access
+        self.group, self.fields = group, fields
+
+class BitField(object):
+    __slots__ = ('name', 'description', 'ranges', 'offset', 'width', 'mask', 'access', 'enumeration')
+    def __init__(self, name, description, ranges, access, enumeration):
+        self.name, self.description = name, description
+        # ranges : (lsb, width) as written in the definition, [15:10][26:25] has two
+        self.ranges = ranges
+        if len(ranges) == 1:
+            # most fields, without the generators
+            self.offset, self.width = ranges[0]
+            self.mask = ((1 << self.width) - 1) << self.offset
+            self.access, self.enumeration = access, enumeration
+            return
+        self.offset = min(r[0] for r in ranges) if ranges else None
+        self.width = sum(r[1] for r in ranges)
+        self.mask = 0
+        for lsb, width in ranges:
+            self.mask |= ((1 << width) - 1) << lsb
+        self.access, self.enumeration = access, enumeration
+
+class Enumeration(object):
+    __slots__ = ('name', 'items')
+    def __init__(self, name, items):
+        # items : (name, value) in document order
+        self.name, self.items = name, items
+
+bit_definitions = {}
+
+def parse_int(s):
+    if s is None:
+        return None
+    try:
+        return int(s, 0)
+    except ValueError:
+        try:
+            return int(s, 10)
+        except ValueError:
+            return None
+
+def bit_ranges(definition):
+    if definition not in bit_definitions:
+        ranges = []
+        for tok in re.findall(r'\[([^\]]*)\]', definition):
+            bits = [parse_int(b) for b in tok.split(':')]
+            if None in bits:
+                continue
+            ranges.append((min(bits), max(bits) - min(bits) + 1))
+        bit_definitions[definition] = tuple(ranges)
+    return bit_definitions[definition]
+
+def model_text(el, tag):
+    return sys.intern(value_of(el.findall(tag))) if el.find(tag) is not None else None
+
+def model_enumeration(e):
+    items = []
+    for i in e.findall(TCF + 'enumItem'):
+        items.append((sys.intern(i.get('name', '')), parse_int(i.get('number'))))
+    if not items and e.get('values'):
+        for tok in e.get('values').split(','):
+            name, _, value = tok.partition('=')
+            items.append((sys.intern(name), parse_int(value)))
+    return Enumeration(sys.intern(e.get('name', '')), tuple(items))
+
+def model_register(reg, group, enums):
+    fields = []
+    for f in reg.findall(CR + 'bitField'):
+        enum = enums.get(f.get('enumerationId')) if f.get('enumerationId') else None
+        fields.append(BitField(sys.intern(f.get('name', '')), model_text(f, CR + 'description'),
+                               bit_ranges(string_value(f.find(CR + 'definition'))) if f.find(CR + 'definition') is not None else (),
+                               f.get('access') and sys.intern(f.get('access')), enum))
+    return Register(sys.intern(reg.get('name', '')), model_text(reg, CR + 'gui_name'), model_text(reg, CR + 'description'),
+                    parse_int(reg.get('offset')), parse_int(reg.get('size')),
+                    reg.get('access') and sys.intern(reg.get('access')), group, tuple(fields))
+
+def model_registers(parent, group, enums, registers):
+    for child in parent:
+        if child.tag == CR + 'register':
+            registers.append(model_register(child, group, enums))
+        elif child.tag == CR + 'register_group':
+            model_registers(child, sys.intern(child.get('name', '')), enums, registers)
+
+def build_core(doc, name):
+    core = doc.getroot()
+    filters = dict((sys.intern(f.get('gui_name', '')), sys.intern(f.get('id', ''))) for f in core.findall('c:reg_filter', svd_ns))
+    rlists = []
+    for rlist in core.iter(CR + 'register_list'):
+        enums = {}
+        for e in rlist.findall(TCF + 'enumeration'):
+            enums.setdefault(e.get('name'), model_enumeration(e))
+        registers = []
+        model_registers(rlist, None, enums, registers)
+        peripherals = []
+        for p in rlist.findall(CR + 'peripheral'):
+            pregs = []
+            model_registers(p, None, enums, pregs)
+            offsets = [r.offset for r in pregs if r.offset is not None]
+            peripherals.append(Peripheral(sys.intern(p.get('name', '')), model_text(p, CR + 'description'),
+                                          model_text(p, CR + 'groupName'), min(offsets) if offsets else None, tuple(pregs)))
+        rlists.append(RegisterList(sys.intern(rlist.get('name', '')), rlist.get('filter') and sys.intern(rlist.get('filter')),
+                                   tuple(registers), tuple(peripherals), enums))
+    return Core(name, value_of(core.findall('c:name', svd_ns)), value_of(core.findall('c:series', svd_ns)), filters, tuple(rlists))
+
+# --header / --json : emitted from the model of the resolved tree, next to the svds
+def c_name(*parts):
+    name = re.sub(r'\W', '_', '_'.join(p for p in parts if p)).upper()
+    return '_' + name if name[:1].isdigit() else name
+
+def c_comment(text):
+    return text.replace('*/', '* /') if text else text
+
+def c_hex(v, shifted=0):
+    # shifted : the value it ends up as, UL is 32 bits on ILP32
+    return '0x%X%s' % (v, 'ULL' if max(v, shifted) > 0xFFFFFFFF else 'UL')
+
+def c_header(core, reg_filter):
+    guard = c_name('ADS2SVD', core.name, reg_filter, 'H')
+    title = core.title + (' ' + reg_filter if reg_filter else '')
+    lines = ['/* %s core registers : offsets, bit fields and enumerated values.' % c_comment(title),
+             '   Generated by ads2svd.py from the ARM Development studio descriptions. */',
+             '#ifndef %s' % guard, '#define %s' % guard, '']
+    defined = {}
+    def define(name, value, comment=None):
+        # the first definition wins (RESERVED enum items, registers listed in several groups)
+        if name in defined:
+            return
+        defined[name] = value
+        lines.append('#define %-48s %s' % (name, value) + (' /* %s */' % c_comment(comment) if comment else ''))
+    def register(prefix, reg, base):
+        if reg.offset is not None and base is not None:
+            define(c_name(prefix, 'OFFSET'), c_hex(reg.offset - base), reg.gui_name)
+        for f in reg.fields:
+            if not f.ranges:
+                continue
+            fname = c_name(prefix, f.name)
+            if len(f.ranges) == 1:
+                define(fname + '_Pos', str(f.offset))
+                define(fname + '_Msk', '(%s << %s_Pos)' % (c_hex((1 << f.width) - 1, f.mask), fname))
+            else:
+                # split field ([15:10][26:25]) : the mask of all its bits
+                define(fname + '_Msk', c_hex(f.mask))
+            if f.enumeration is not None:
+                for item, value in f.enumeration.items:
+                    if value is not None:
+                        define(c_name(prefix, f.name, item), c_hex(value))
+    fid = core.filters.get(reg_filter, reg_filter)
+    for rlist in core.register_lists:
+        if reg_filter is not None and rlist.filter not in (None, fid):
+            continue
+        if rlist.registers:
+            lines += ['', '/* %s */' % c_comment(rlist.name)]
+            for reg in rlist.registers:
+                register(c_name(reg.name), reg, None)
+        for p in rlist.peripherals:
+            lines += ['', '/* %s%s */' % (p.name, ' : ' + c_comment(p.description) if p.description else '')]
+            if p.base is not None:
+                define(c_name(p.name, 'BASE'), c_hex(p.base))
+            for reg in p.registers:
+                # NVIC_ISER0 rather than NVIC_NVIC_ISER0
+                register(c_name(reg.name) if c_name(reg.name).startswith(c_name(p.name) + '_') else c_name(p.name, reg.name), reg, p.base)
+    lines += ['', '#endif /* %s */' % guard, '']
+    return '\n'.join(lines)
+
+def core_json(core):
+    def field(f):
+        return {"name" : f.name, "description" : f.description, "bits" : f.ranges, "offset" : f.offset,
+                "width" : f.width, "mask" : f.mask, "access" : f.access,
+                "enumeration" : f.enumeration.name if f.enumeration is not None else None}
+    def register(r):
+        return {"name" : r.name, "gui_name" : r.gui_name, "description" : r.description, "offset" : r.offset,
+                "size" : r.size, "access" : r.access, "group" : r.group, "fields" : [field(f) for f in r.fields]}
+    return {"name" : core.name, "title" : core.title, "series" : core.series, "filters" : core.filters,
+            "register_lists" : [{"name" : rlist.name, "filter" : rlist.filter,
+                                 "enumerations" : dict((e.name, e.items) for e in rlist.enumerations.values()),
+                                 "registers" : [register(r) for r in rlist.registers],
+                                 "peripherals" : [{"name" : p.name, "description" : p.description, "group_name" : p.group_name,
+                                                   "base" : p.base, "registers" : [register(r) for r in p.registers]}
+                                                  for p in rlist.peripherals]}
+                                for rlist in core.register_lists]}
+
+def write_model_outputs(resolver, core, out_base):
+    # same file names as the svds : one header per reg_filter, the json has them all
+    paths = []
+    if resolver.config["header"]:
+        for reg_filter in sorted(core.filters) or [None]:
+            path = out_base + ('_' + reg_filter if reg_filter is not None else '') + '.h'
+            paths.append((path, write_output(resolver, path, c_header(core, reg_filter))))
+    if resolver.config["json"]:
+        paths.append((out_base + '.json', write_output(resolver, out_base + '.json', json.dumps(core_json(core), separators=(',', ':')))))
+    if resolver.config["export"]:
+        paths += write_export(resolver, core, out_base)
+    return paths
+
+# --export json|binary : the model as a string table and flat integer tables,
+# for the tools that load a core at startup. load_export reads either back
+# into the model with one read and no xml parsing. None is -1 in the tables.
+EXPORT_MAGIC = b'ADS2SVD-REGS 1\n'
+EXPORT_TABLES = (
+    # table, columns per row
+    ('filters', 2),        # gui_name, id
+    ('register_lists', 8), # name, filter, first register, count, first peripheral, count, first enumeration, count
+    ('peripherals', 6),    # name, description, group_name, base, first register, count
+    ('registers', 9),      # name, gui_name, description, offset, size, access, group, first field, count
+    ('fields', 6),         # name, description, access, enumeration, first range, count
+    ('ranges', 2),         # lsb, width
+    ('enumerations', 3),   # name, first item, count
+    ('items', 2),          # name, value
+)
+
+def export_tables(core):
+    strings = {}
+    def sid(s):
+        if s is None:
+            return -1
+        if s not in strings:
+            strings[s] = len(strings)
+        return strings[s]
+    def num(n):
+        return -1 if n is None else n
+    t = dict((name, []) for name, _ in EXPORT_TABLES)
+    for gui_name, fid in sorted(core.filters.items()):
+        t['filters'] += [sid(gui_name), sid(fid)]
+    def registers(regs, enums):
+        first = len(t['registers']) // 9
+        for r in regs:
+            t['registers'] += [sid(r.name), sid(r.gui_name), sid(r.description), num(r.offset), num(r.size),
+                               sid(r.access), sid(r.group), len(t['fields']) // 6, len(r.fields)]
+            for f in r.fields:
+                t['fields'] += [sid(f.name), sid(f.description), sid(f.access),
+                                enums[id(f.enumeration)] if f.enumeration is not None else -1,
+                                len(t['ranges']) // 2, len(f.ranges)]
+                for lsb, width in f.ranges:
+                    t['ranges'] += [lsb, width]
+        return first, len(regs)
+    for rlist in core.register_lists:
+        enums = {}
+        first_enum = len(t['enumerations']) // 3
+        for e in rlist.enumerations.values():
+            enums[id(e)] = len(t['enumerations']) // 3
+            t['enumerations'] += [sid(e.name), len(t['items']) // 2, len(e.items)]
+            for name, value in e.items:
+                t['items'] += [sid(name), num(value)]
+        # the register list rows come after their registers and peripherals
+        reg = registers(rlist.registers, enums)
+        first_p = len(t['peripherals']) // 6
+        for p in rlist.peripherals:
+            preg = registers(p.registers, enums)
+            t['peripherals'] += [sid(p.name), sid(p.description), sid(p.group_name), num(p.base), preg[0], preg[1]]
+        t['register_lists'] += [sid(rlist.name), sid(rlist.filter), reg[0], reg[1], first_p, len(rlist.peripherals),
+                                first_enum, len(rlist.enumerations)]
+    return [sid(core.name), sid(core.title), sid(core.series)], sorted(strings, key=strings.get), t
+
+def write_export(resolver, core, out_base):
+    head, strings, tables = export_tables(core)
+    paths = []
+    if 'json' in resolver.config["export"]:
+        paths.append((out_base + '.min.json', write_output(resolver, out_base + '.min.json', json.dumps(dict(tables, core=head, strings=strings), separators=(',', ':')))))
+    if 'binary' in resolver.config["export"]:
+        # magic, table lengths and string blob length (int64), the tables, the nul separated strings
+        blob = '\0'.join(strings).encode()
+        ints = array.array('q', head)
+        ints.extend(len(tables[name]) for name, _ in EXPORT_TABLES)
+        ints.append(len(blob))
+        for name, _ in EXPORT_TABLES:
+            ints.extend(tables[name])
+        data = EXPORT_MAGIC + struct.pack('<q', len(ints)) + (ints.tobytes() if sys.byteorder == 'little' else byteswapped(ints)) + blob
+        paths.append((out_base + '.regs', write_output(resolver, out_base + '.regs', data)))
+    return paths
+
+def byteswapped(ints):
+    ints = array.array('q', ints)
+    ints.byteswap()
+    return ints.tobytes()
+
+def load_export(path, reg_filter=None):
+    # reg_filter : gui_name or id, only the register lists of that filter (and the
+    # ones without) are built, like Snapshot.load
+    data = read_output(path)
+    if data.startswith(EXPORT_MAGIC):
+        pos = len(EXPORT_MAGIC)
+        n = struct.unpack_from('<q', data, pos)[0]
+        pos += 8
+        ints = array.array('q')
+        ints.frombytes(data[pos:pos + 8 * n])
+        if sys.byteorder != 'little':
+            ints.byteswap()
+        strings = data[pos + 8 * n:].decode().split('\0')
+        head = ints[0:3]
+        sizes = ints[3:3 + len(EXPORT_TABLES)]
+        pos = 4 + len(EXPORT_TABLES)
+        tables = {}
+        for (name, _), size in zip(EXPORT_TABLES, sizes):
+            tables[name] = ints[pos:pos + size]
+            pos += size
+    else:
+        d = json.loads(data)
+        head, strings, tables = d["core"], d["strings"], d
+    return core_from_tables(head, strings, tables, reg_filter)
+
+def core_from_tables(head, strings, t, reg_filter=None):
+    # a string index of -1 is None : the last item of S
+    S = list(strings) + [None]
+    N = lambda n: n if n >= 0 else None
+    filters = dict((S[t['filters'][i]], S[t['filters'][i + 1]]) for i in range(0, len(t['filters']), 2))
+    fid = None
+    if reg_filter is not None:
+        fid = filters.get(reg_filter, reg_filter)
+        if fid not in filters.values():
+            raise KeyError("%s has no reg_filter %s" % (S[head[0]], reg_filter))
+    f_, r_, e_ = t['fields'], t['ranges'], t['items']
+    ranges = list(zip(r_[0::2], r_[1::2]))
+    enums = {}
+    def enum(i):
+        # built once, by the first register list using it
+        if i not in enums:
+            first, count = t['enumerations'][3 * i + 1], t['enumerations'][3 * i + 2]
+            enums[i] = Enumeration(S[t['enumerations'][3 * i]],
+                                   tuple((S[e_[2 * j]], N(e_[2 * j + 1])) for j in range(first, first + count)))
+        return enums[i]
+    def registers(first, count):
+        regs = []
+        rt = t['registers']
+        for k in range(first, first + count):
+            r = rt[9 * k:9 * k + 9]
+            fields = []
+            for j in range(r[7], r[7] + r[8]):
+                f = f_[6 * j:6 * j + 6]
+                fields.append(BitField(S[f[0]], S[f[1]], tuple(ranges[f[4]:f[4] + f[5]]), S[f[2]], enum(f[3]) if f[3] >= 0 else None))
+            regs.append(Register(S[r[0]], S[r[1]], S[r[2]], N(r[3]), N(r[4]), S[r[5]], S[r[6]], tuple(fields)))
+        return tuple(regs)
+    rlists = []
+    lt, pt = t['register_lists'], t['peripherals']
+    for i in range(0, len(lt), 8):
+        l = lt[i:i + 8]
+        if fid is not None and S[l[1]] not in (None, fid):
+            continue
+        peripherals = tuple(Peripheral(S[pt[6 * k]], S[pt[6 * k + 1]], S[pt[6 * k + 2]], N(pt[6 * k + 3]),
+                                       registers(pt[6 * k + 4], pt[6 * k + 5])) for k in range(l[4], l[4] + l[5]))
+        rlists.append(RegisterList(S[l[0]], S[l[1]], registers(l[2], l[3]), peripherals,
+                                   dict((e.name, e) for e in map(enum, range(l[6], l[6] + l[7])))))
+    return Core(S[head[0]], S[head[1]], S[head[2]], filters, tuple(rlists))
+
+def object_path(out_dir, h):
+    return os.path.join(out_dir, 'objects', h[:2], h + '.gz')
+
+class HashingWriter(object):
+    # file object for lxml : the sha1 of what goes through, gzipped on the way out
+    def __init__(self, f):
+        self.sha1 = hashlib.sha1()
+        # mtime 0 : the same content always gives the same object
+        self.gz = gzip.GzipFile(filename='', mode='wb', fileobj=f, mtime=0)
+
+    def write(self, data):
+        self.sha1.update(data)
+        self.gz.write(data)
+
+    def close(self):
+        self.gz.close()
+
+def write_output(resolver, path, data):
+    # every output of a core goes through here, returns the bytes it took on disk.
+    # data is bytes or str, or a function writing to a file object : the big
+    # trees are serialized straight to the file, never held as one string
+    if not callable(data):
+        data = data.encode() if isinstance(data, str) else data
+        write = lambda f: f.write(data)
+    else:
+        write = data
+    if not resolver.config.get("store"):
+        with open(path, 'wb') as f:
+            write(f)
+            return f.tell()
+    objects = os.path.join(os.path.dirname(path), 'objects')
+    os.makedirs(objects, exist_ok=True)
+    tmp = os.path.join(objects, '%d.tmp' % os.getpid())
+    with open(tmp, 'wb') as f:
+        w = HashingWriter(f)
+        write(w)
+        w.close()
+    h = w.sha1.hexdigest()
+    obj = object_path(os.path.dirname(path), h)
+    if os.path.isfile(obj):
+        os.remove(tmp)
+    else:
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        os.replace(tmp, obj)
+    resolver.store_entries[os.path.basename(path)] = h
+    # a plain file wins over the store, one left by an earlier run would hide this one
+    if os.path.isfile(path):
+        os.remove(path)
+    return os.path.getsize(obj)
+
+def load_store(out_dir):
+    try:
+        with open(os.path.join(out_dir, 'store.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_store(resolver):
+    with open(resolver.config["store_file"] + '.tmp', 'w') as f:
+        json.dump(resolver.store_index, f, indent=1, sort_keys=True)
+    os.replace(resolver.config["store_file"] + '.tmp', resolver.config["store_file"])
+    # the objects no name maps to any more (a rebuilt svd has a new <version>) go
+    live = set(resolver.store_index.values())
+    for obj in glob.glob(os.path.join(resolver.config["out_dir"], 'objects', '*', '*.gz')):
+        if os.path.basename(obj)[:-3] not in live:
+            os.remove(obj)
+
+def read_output(path, store=None):
+    # the plain file, else the object stored under its name
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            return f.read()
+    h = (load_store(os.path.dirname(path)) if store is None else store).get(os.path.basename(path))
+    if h is None:
+        raise FileNotFoundError("no %s, plain or in the store" % path)
+    with gzip.open(object_path(os.path.dirname(path), h)) as f:
+        return f.read()
+
+def output_names(out_dir, store=None):
+    store = load_store(out_dir) if store is None else store
+    return sorted(set(os.listdir(out_dir)) | set(store))
+
+def file_hash(resolver, path):
+    if path not in resolver.file_hashes:
+        try:
+            with open(path, 'rb') as f:
+                resolver.file_hashes[path] = hashlib.sha1(f.read()).hexdigest()
+        except OSError:
+            resolver.file_hashes[path] = None
+    return resolver.file_hashes[path]
+
+def core_deps(resolver, p, direct):
+    # transitive closure of the include graph, the core itself first
+    deps = [p]
+    seen = set(deps)
+    todo = sorted(direct)
+    while todo:
+        d = todo.pop(0)
+        if d in seen:
+            continue
+        seen.add(d)
+        deps.append(d)
+        todo.extend(sorted(resolver.include_deps.get(d, ())))
+    return deps
+
+def write_depfile(resolver, p, deps):
+    out_file = os.path.join(resolver.config["out_dir"] , p.split(os.path.sep)[-1])
+    rel = [os.path.relpath(d) for d in deps]
+    with open(out_file[:-4] + '.d', 'w') as depfile:
+        depfile.write('%s %s: %s\n' % (out_file, os.path.join(resolver.config["out_dir"], '.resolved'), ' '.join(rel)))
+        # like gcc -MP, a deleted include must not break make
+        for d in rel[1:]:
+            depfile.write('\n%s:\n' % d)
+    return out_file[:-4] + '.d'
+
+def core_stats(p):
+    # stats : wall time of each stage in seconds, plus the counters of --stats
+    return {"core" : p.split(os.path.sep)[-1], "parse" : 0.0, "xinclude" : 0.0, "failures" : 0.0,
+            "serialize" : 0.0, "svd" : 0.0, "emit" : 0.0, "depfile" : 0.0, "validate" : 0.0, "index" : 0.0,
+            "includes" : 0, "includes_failed" : 0, "invalid" : 0, "bytes_in" : 0, "bytes_out" : 0}
+
+def resolve_tree(resolver, p, stats):
+    # the core with its includes spliced in, the failed ones left as FAIL comments
+    t = time.perf_counter()
     curr_path = os.path.sep.join(p.split(os.path.sep)[:-1])
-    root = etree.parse(p,xmlparser)
-    error_log = open(config["xinclude_error_log"],"a")
-    out_file = os.path.join(config["out_dir"] , p.split(os.path.sep)[-1])
-    out_file = open(out_file,"w")
+    root = etree.parse(p,resolver.parser)
+    if resolver.config["validate"] == "once":
+        t = stage(stats, "parse", t)
+        validate_source(resolver, p, root)
+        t = stage(stats, "validate", t)
+    errors = []
     nfail = 0;  
+    direct = set()
     incls = [i for i in root.xpath("//xi:include", namespaces={'xi':'http://www.w3.org/2001/XInclude'})]
+    stats["includes"] = len(incls)
+    t = stage(stats, "parse", t)
     for el in incls:        
-        tree =  etree.ElementTree(el)
         try :
-            tree.xinclude()
+            resolve_include(resolver, el, curr_path, direct)
             #error_log.write( 'SUCC "%s";"%s";\n' % (p[len(config["base_path"]):],orighref))         
-        except lxml.etree.XIncludeError as err:
+        except (lxml.etree.XIncludeError, IncludeError) as err:
+            t = stage(stats, "xinclude", t)
             if el.get("href"):
-                error_log.write( 'ERR;num=%d;file="%s";errhref="%s";errreason="%s";merrmsg="%s"\n' % (nfail,p[len(config["configdb_path"]):],el.get("href"),el.get("xpointer"),err))
+                errors.append( 'ERR;num=%d;file="%s";errhref="%s";errreason="%s";merrmsg="%s"\n' % (nfail,p[len(resolver.config["configdb_path"]):],el.get("href"),el.get("xpointer"),err))
                 nfail+=1
-                error_log.flush()
                 pap = el.getparent()        
                 pap.append(etree.Comment( b'FAIL : %d ' % (nfail) + etree.tostring( el)))
                 pap.remove(el)
-    out_file.write(etree.tostring(root, pretty_print=True).decode("utf8"))
+            t = stage(stats, "failures", t)
+    stage(stats, "xinclude", t)
+    stats["includes_failed"] = nfail
+    return root, errors, direct
+
+def current_rss():
+    # resident set size in bytes, the peak where there is no /proc
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def trim_caches(resolver):
+    # --max-memory : a process past its share drops the parsed includes before the
+    # next core (the hashes, selectors and include graph stay, they are small)
+    if not resolver.config.get("max_rss") or current_rss() <= resolver.config["max_rss"]:
+        return
+    resolver.include_docs.clear()
+    resolver.include_results.clear()
+    try:
+        # give the freed pages back, or the rss would not go down
+        ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def resolve_core(resolver, p):
+    trim_caches(resolver)
+    del resolver.new_repairs[:]
+    stats = core_stats(p)
+    root, errors, direct = resolve_tree(resolver, p, stats)
+    # the includes are spliced in, the svds and the model only need the tree
+    trim_caches(resolver)
+    t = time.perf_counter()
+    resolver.store_entries.clear()
+    out_file = os.path.join(resolver.config["out_dir"] , p.split(os.path.sep)[-1])
+    stats["bytes_out"] += write_output(resolver, out_file, lambda f: root.write(f, pretty_print=True))
+    # the files written for the core, the manifest lists them for --stale
+    outputs = [out_file]
+    t = stage(stats, "serialize", t)
+    if resolver.config["svd"]:
+        try:
+            for path, size in write_svds(resolver, root, os.path.join(resolver.config["out_dir"], p.split(os.path.sep)[-1][:-4])):
+                outputs.append(path)
+                stats["bytes_out"] += size
+        except ValueError as err:
+            sys.stderr.write("%s : svd generation failed : %s\n" % (p, err))
+        t = stage(stats, "svd", t)
+    model = None
+    if resolver.config["header"] or resolver.config["json"] or resolver.config["export"] or resolver.config["index"]:
+        model = build_core(root, p.split(os.path.sep)[-1][:-4])
+    if resolver.config["header"] or resolver.config["json"] or resolver.config["export"]:
+        for path, size in write_model_outputs(resolver, model, os.path.join(resolver.config["out_dir"], p.split(os.path.sep)[-1][:-4])):
+            outputs.append(path)
+            stats["bytes_out"] += size
+        t = stage(stats, "emit", t)
+    deps = core_deps(resolver, p, direct)
+    outputs.append(write_depfile(resolver, p, deps))
+    stats["bytes_in"] = sum(os.path.getsize(d) for d in deps if os.path.isfile(d))
+    t = stage(stats, "depfile", t)
+    entries = None
+    if resolver.config["index"]:
+        details = register_details(model)
+        entries = (core_index(model), dict((k, v[0]) for k, v in details.items()), details)
+        t = stage(stats, "index", t)
+    invalid = []
+    if resolver.config["validate"] == "full":
+        # the xml:base of the include fixup is not in the schemas, the tree is
+        # not needed any more once written
+        for el in root.iter(etree.Element):
+            el.attrib.pop(XML_BASE, None)
+        invalid = invalid_lines(resolver, p, schema_errors(resolver, root))
+    elif resolver.config["validate"] == "once":
+        for d in deps:
+            invalid += invalid_lines(resolver, d, resolver.validated.get(file_hash(resolver, d), []))
+    stats["invalid"] = len(invalid)
+    stage(stats, "validate", t)
+    valid = dict((file_hash(resolver, d), resolver.validated[file_hash(resolver, d)]) for d in deps if file_hash(resolver, d) in resolver.validated)
+    built = {"deps" : dict((os.path.relpath(d, resolver.config["configdb_path"]), file_hash(resolver, d)) for d in deps),
+             "outputs" : sorted(os.path.basename(o) for o in outputs), "flags" : output_flags(resolver.config)}
+    return errors, built, stats, invalid, valid, entries, dict(resolver.store_entries), list(resolver.new_repairs)
+
+def stage(stats, name, t):
+    now = time.perf_counter()
+    stats[name] += now - t
+    return now
+
+def log_errors(resolver, errors):
+    error_log = open(resolver.config["xinclude_error_log"],"a")
+    error_log.writelines(errors)
     error_log.close()
-    out_file.close()
 
-def get_dev():
-    error_log = open(config["xinclude_error_log"],"w+")
+def log_invalid(resolver, invalid):
+    # an include shared by several cores is reported once
+    invalid = [l for l in invalid if l not in resolver.reported_invalid]
+    resolver.reported_invalid.update(invalid)
+    if not invalid:
+        return
+    sys.stderr.writelines(invalid)
+    with open(resolver.config["validation_log"], "a") as f:
+        f.writelines(invalid)
+
+def log_repairs(resolver, p, repairs):
+    # a target found by --repair is reported once, with the first core needing it
+    lines = []
+    for path, cand in repairs:
+        if (path, cand) not in resolver.reported_repairs:
+            resolver.reported_repairs.add((path, cand))
+            lines.append('REPAIRED;file="%s";to="%s";core="%s"\n' % (path[len(resolver.config["configdb_path"]):], cand[len(resolver.config["configdb_path"]):], p[len(resolver.config["configdb_path"]):]))
+    if lines:
+        with open(resolver.config["repair_log"], "a") as f:
+            f.writelines(lines)
+
+def log_core(resolver, p, res, manifest, stats_log):
+    errors, manifest[p.split(os.path.sep)[-1]], stats, invalid, valid, entries, stored, repairs = res
+    resolver.store_index.update(stored)
+    log_repairs(resolver, p, repairs)
+    if entries is not None:
+        resolver.index_entries[p.split(os.path.sep)[-1][:-4]] = entries
+    resolver.errors[p.split(os.path.sep)[-1][:-4]] = errors
+    resolver.invalid[p.split(os.path.sep)[-1][:-4]] = invalid
+    log_errors(resolver, errors)
+    log_invalid(resolver, invalid)
+    resolver.validated.update(valid)
+    log_stats(stats_log, stats)
+
+def loadxml(resolver, p, manifest, stats_log=None):
+    print(p)
+    log_core(resolver, p, resolve_core(resolver, p), manifest, stats_log)
+
+def resolve_job(p, resolver=None):
+    # worker side (the Resolver of the process when none is given) : the exception
+    # itself may not pickle (lxml errors carry their error log), the parent only gets its text
+    try:
+        return None, resolve_core(resolver or worker, p)
+    except Exception as err:
+        return '%s: %s' % (type(err).__name__, err), None
+
+def log_failed(resolver, p, err):
+    # the core is left out of the manifest, the next run redoes it
+    resolver.failed_cores.append(p)
+    sys.stderr.write("%s : resolve failed : %s\n" % (p, err))
+
+def log_stats(stats_log, stats):
+    if stats_log is None:
+        return
+    stats_log["cores"].append(stats)
+    with open(stats_log["path"], "a") as f:
+        f.write(json.dumps(stats, sort_keys=True) + "\n")
+
+def open_stats(path):
+    # one json object per core, in input order, then a summary line
+    if not path:
+        return None
+    open(path, "w").close()
+    return {"path" : path, "cores" : [], "start" : time.perf_counter()}
+
+def close_stats(stats_log):
+    if stats_log is None:
+        return
+    cores = stats_log["cores"]
+    summary = {"summary" : True, "cores" : len(cores), "jobs" : stats_log.get("jobs", 1),
+               "wall" : time.perf_counter() - stats_log["start"]}
+    for k in ("parse", "xinclude", "failures", "serialize", "svd", "emit", "depfile", "validate", "index",
+              "includes", "includes_failed", "invalid", "bytes_in", "bytes_out"):
+        summary[k] = sum(c[k] for c in cores)
+    summary["slowest"] = [c["core"] for c in sorted(cores, key=lambda c: -(c["parse"] + c["xinclude"] + c["failures"] + c["serialize"] + c["svd"] + c["emit"] + c["depfile"] + c["validate"] + c["index"]))[:10]]
+    with open(stats_log["path"], "a") as f:
+        f.write(json.dumps(summary, sort_keys=True) + "\n")
+
+# worker processes : the Resolver of the process, made by init_worker
+worker = None
+
+def init_worker(cfg, valid):
+    # every worker keeps its own include cache, and builds the schema on its first validation
+    global worker
+    worker = Resolver.from_config(cfg)
+    worker.validated.update(valid)
+
+def jobserver():
+    # make hands its job slots to recipes marked with '+' through MAKEFLAGS,
+    # either as a named fifo (make >= 4.4) or as an inherited pipe
+    m = re.search(r'--jobserver-(?:auth|fds)=(fifo:(\S+)|(\d+),(\d+))', os.environ.get("MAKEFLAGS", ""))
+    if not m:
+        return None
+    try:
+        if m.group(2):
+            rfd = os.open(m.group(2), os.O_RDONLY | os.O_NONBLOCK)
+            wfd = os.open(m.group(2), os.O_WRONLY)
+        else:
+            rfd, wfd = int(m.group(3)), int(m.group(4))
+            os.fstat(rfd)
+            os.fstat(wfd)
+    except OSError:
+        # not a '+' recipe, make did not give us the pipe : we are a single job
+        return None
+    return rfd, wfd
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(path, manifest):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+def load_validated(resolver):
+    try:
+        with open(resolver.config["validated"]) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return
+    if cache.get("schema") == schema_hash(resolver):
+        resolver.validated.update((h, [tuple(e) for e in errs]) for h, errs in cache["files"].items())
+
+def save_validated(resolver):
+    with open(resolver.config["validated"] + '.tmp', 'w') as f:
+        json.dump({"schema" : schema_hash(resolver), "files" : resolver.validated}, f, sort_keys=True)
+    os.replace(resolver.config["validated"] + '.tmp', resolver.config["validated"])
+
+def output_flags(cfg):
+    # the options that decide which files a core gets and what is in them
+    return {"svd" : cfg["svd"], "derive" : cfg["svd"] and cfg["derive"], "header" : cfg["header"], "json" : cfg["json"],
+            "export" : sorted(cfg["export"]), "index" : cfg["index"]}
+
+def is_stale(resolver, p, manifest):
+    # stale when the last build of the core did not make an output asked for now,
+    # when one of the files it wrote is gone, or when any file of the include graph changed
+    built = manifest.get(p.split(os.path.sep)[-1])
+    if not built or "deps" not in built:
+        return True
+    wanted = output_flags(resolver.config)
+    if wanted["svd"] and built["flags"]["derive"] != wanted["derive"]:
+        return True
+    if any(wanted[k] and not built["flags"][k] for k in ("svd", "header", "json", "index")):
+        return True
+    if not set(wanted["export"]) <= set(built["flags"]["export"]):
+        return True
+    if wanted["index"] and not os.path.isfile(resolver.config["index_file"]):
+        return True
+    for name in built["outputs"]:
+        if not (os.path.isfile(os.path.join(resolver.config["out_dir"], name)) or name in resolver.store_index):
+            return True
+    return any(file_hash(resolver, os.path.join(resolver.config["configdb_path"], d)) != h for d, h in built["deps"].items())
+
+def loadxmls(resolver, xmls_cores):
+    stats_log = open_stats(resolver.config["stats"])
+    manifest = load_manifest(resolver.config["manifest"])
+    open(resolver.config["validation_log"], "w").close()
+    if resolver.config["repair"]:
+        open(resolver.config["repair_log"], "w").close()
+    resolver.reported_repairs.clear()
+    resolver.reported_invalid.clear()
+    resolver.index_entries.clear()
+    resolver.errors.clear()
+    resolver.invalid.clear()
+    del resolver.failed_cores[:]
+    resolver.store_index.clear()
+    resolver.store_index.update(load_store(resolver.config["out_dir"]))
+    if resolver.config["validate"] == "once":
+        load_validated(resolver)
+    if resolver.config["only_stale"]:
+        xmls_cores = [x for x in xmls_cores if is_stale(resolver, x, manifest)]
+    if not xmls_cores:
+        # nothing to redo, the run files (index, store, manifest) are still written
+        done_loading(resolver, manifest, stats_log)
+        return
+    js = jobserver()
+    jobs = min(resolver.config["jobs"] or (os.cpu_count() if js else 1), len(xmls_cores))
+    # every process gets its share of --max-memory
+    resolver.config["max_rss"] = (resolver.config["max_memory"] << 20) // jobs if resolver.config["max_memory"] else None
+    if jobs <= 1:
+        for x in xmls_cores:
+            print(x)
+            err, res = resolve_job(x, resolver)
+            if err is None:
+                log_core(resolver, x, res, manifest, stats_log)
+            else:
+                log_failed(resolver, x, err)
+        done_loading(resolver, manifest, stats_log)
+        return
+    # workers only write their own output file, the parent prints and logs in
+    # input order so the console and xinclude_error.log match a serial run.
+    # Under make we own one implicit slot and borrow the others from the jobserver.
+    tokens = []
+    pending = list(xmls_cores)
+    running = []
+    done = {}
+    emitted = 0
+    try:
+        with multiprocessing.Pool(jobs, init_worker, (resolver.config, resolver.validated)) as pool:
+            while pending or running:
+                slots = jobs if not js else min(jobs, 1 + len(tokens))
+                if pending and len(running) < slots:
+                    x = pending.pop(0)
+                    running.append((x, pool.apply_async(resolve_job, (x,))))
+                    if stats_log is not None:
+                        # the workers really used, the jobserver may give fewer slots than -j
+                        stats_log["jobs"] = max(stats_log.get("jobs", 1), len(running))
+                    continue
+                if pending and js and slots < jobs and select.select([js[0]], [], [], 0.01)[0]:
+                    try:
+                        tokens.append(os.read(js[0], 1))
+                    except BlockingIOError:
+                        pass
+                    continue
+                finished = [job for job in running if job[1].ready()]
+                if not finished:
+                    running[0][1].wait(0.05)
+                    continue
+                for job in finished:
+                    running.remove(job)
+                    done[job[0]] = job[1].get()
+                while tokens and len(tokens) >= min(jobs, len(running) + len(pending)):
+                    os.write(js[1], tokens.pop())
+                while emitted < len(xmls_cores) and xmls_cores[emitted] in done:
+                    x = xmls_cores[emitted]
+                    print(x)
+                    err, res = done.pop(x)
+                    if err is None:
+                        log_core(resolver, x, res, manifest, stats_log)
+                    else:
+                        log_failed(resolver, x, err)
+                    emitted += 1
+    finally:
+        # a failed worker or pool must not keep make's slots
+        while tokens:
+            os.write(js[1], tokens.pop())
+    done_loading(resolver, manifest, stats_log)
+
+def done_loading(resolver, manifest, stats_log):
+    save_manifest(resolver.config["manifest"], manifest)
+    if resolver.config["store"]:
+        save_store(resolver)
+    if resolver.config["validate"] == "once":
+        save_validated(resolver)
+    if resolver.config["index"]:
+        write_index(resolver, manifest)
+    close_stats(stats_log)
+
+# packed snapshot of the resolved corpus : every core of the manifest cut in a
+# skeleton (its out/*.xml without the register lists of a reg_filter) and those
+# register lists, one slice each, all back to back. Then a json index (byte range of
+# the skeleton, reg_filters, and filter id, place in the skeleton and byte range of
+# every slice, by core name) and the index offset as 16 hex digits. Snapshot() mmaps
+# it and only parses the skeleton with the slices asked for put back.
+SNAPSHOT_MAGIC = b'ADS2SVD-SNAPSHOT 2\n'
+reg_filter_tag = re.compile(rb'<(?:\w+:)?reg_filter\b([^>]*)>')
+register_list_tag = re.compile(rb'<(/?)(?:[\w.-]+:)?register_list\b([^>]*?)(/?)>')
+xml_attr = re.compile(rb'(\w+)="([^"]*)"')
+
+def snapshot_slices(data):
+    # [(filter id, start, end)] of the outermost register lists with a filter, on the
+    # bytes (no parse) : the out/*.xml are lxml output, '>' is escaped in the attributes
+    slices = []
+    depth = 0
+    start = None
+    for m in register_list_tag.finditer(data):
+        if m.group(1):
+            depth -= 1
+            if start is not None and depth == start[1]:
+                slices.append((start[0], start[2], m.end()))
+                start = None
+            continue
+        if start is None:
+            fid = dict(xml_attr.findall(m.group(2))).get(b'filter')
+            if fid is not None:
+                if m.group(3):
+                    slices.append((fid.decode(), m.start(), m.end()))
+                    continue
+                start = (fid.decode(), depth, m.start())
+        if not m.group(3):
+            depth += 1
+    return slices
+
+def write_snapshot(out_dir, path):
+    index = {}
+    with open(path + '.tmp', 'wb') as snap:
+        snap.write(SNAPSHOT_MAGIC)
+        store = load_store(out_dir)
+        for name in sorted(load_manifest(os.path.join(out_dir, 'manifest.json'))):
+            try:
+                data = read_output(os.path.join(out_dir, name), store)
+            except OSError:
+                continue
+            filters = {}
+            for m in reg_filter_tag.finditer(data):
+                attrs = dict(xml_attr.findall(m.group(1)))
+                filters[attrs.get(b'gui_name', b'').decode()] = attrs.get(b'id', b'').decode()
+            slices = snapshot_slices(data) if filters else []
+            skeleton = []
+            pos = 0
+            for _, start, end in slices:
+                skeleton.append(data[pos:start])
+                pos = end
+            skeleton = b''.join(skeleton) + data[pos:]
+            entry = index[name[:-4]] = {"offset" : snap.tell(), "length" : len(skeleton), "filters" : filters, "slices" : []}
+            snap.write(skeleton)
+            # where every slice goes back in the skeleton
+            cut = 0
+            for fid, start, end in slices:
+                entry["slices"].append([fid, start - cut, snap.tell(), end - start])
+                snap.write(data[start:end])
+                cut += end - start
+        offset = snap.tell()
+        snap.write(json.dumps({"cores" : index}, sort_keys=True).encode())
+        snap.write(b'%016x' % offset)
+    os.replace(path + '.tmp', path)
+
+class Snapshot(object):
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError("%s is not an ads2svd snapshot" % path)
+        offset = int(self.map[-16:], 16)
+        self.index = json.loads(self.map[offset:-16])["cores"]
+
+    def cores(self):
+        return sorted(self.index)
+
+    def filters(self, core):
+        return self.index[core]["filters"]
+
+    def load(self, core, reg_filter=None):
+        # reg_filter : gui_name (AArch64) or id (A72_AARCH64), the register
+        # lists of the other filters are not parsed
+        entry = self.index[core]
+        fid = None
+        if reg_filter is not None:
+            fid = entry["filters"].get(reg_filter, reg_filter)
+            if fid not in entry["filters"].values():
+                raise KeyError("%s has no reg_filter %s" % (core, reg_filter))
+        parts = []
+        pos = entry["offset"]
+        for slice_fid, at, offset, length in entry["slices"]:
+            parts.append(self.map[pos:entry["offset"] + at])
+            pos = entry["offset"] + at
+            if fid in (None, slice_fid):
+                parts.append(self.map[offset:offset + length])
+        parts.append(self.map[pos:entry["offset"] + entry["length"]])
+        doc = etree.ElementTree(etree.fromstring(b''.join(parts), rawparser))
+        if fid is not None:
+            # a register list of another filter inside a kept one
+            for rlist in list(doc.iter(CR + 'register_list')):
+                if rlist.get('filter') not in (None, fid):
+                    rlist.getparent().remove(rlist)
+        return doc
+
+    def model(self, core):
+        return build_core(self.load(core), core)
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+# register index : out/registers.idx, one sorted line per (key, register) with
+# the lowercase key first, so a lookup is a bisection on the mmap-ed file
+INDEX_KINDS = ('name', 'gui_name', 'field', 'offset')
+
+def index_field(v):
+    return re.sub(r'[\t\n]', ' ', v or '')
+
+def core_index(core):
+    # key, kind, key as written, core, reg_filter (gui_name), register_list, peripheral, register
+    filter_names = dict((fid, name) for name, fid in core.filters.items())
+    entries = set()
+    for rlist in core.register_lists:
+        flt = filter_names.get(rlist.filter, rlist.filter)
+        for p, regs in [(None, rlist.registers)] + [(p, p.registers) for p in rlist.peripherals]:
+            for reg in regs:
+                where = tuple(map(index_field, (core.name, flt, rlist.name, p and p.name, reg.name)))
+                keys = [('name', reg.name), ('gui_name', reg.gui_name)]
+                keys += [('field', f.name) for f in reg.fields]
+                if reg.offset is not None:
+                    keys.append(('offset', '0x%08x' % reg.offset))
+                for kind, key in keys:
+                    if key and (kind != 'gui_name' or key != reg.name):
+                        entries.add('\t'.join((index_field(key).lower(), kind, index_field(key)) + where) + '\n')
+    return sorted(entries)
+
+def write_index(resolver, manifest):
+    # the cores of this run replace their old lines, the others are kept
+    cores = set(name[:-4] for name in manifest)
+    lines = []
+    try:
+        with open(resolver.config["index_file"]) as f:
+            for line in f:
+                core = line.split('\t', 4)[3]
+                if core in cores and core not in resolver.index_entries:
+                    lines.append(line)
+    except OSError:
+        pass
+    for entries, _, _ in resolver.index_entries.values():
+        lines.extend(entries)
+    lines.sort()
+    with open(resolver.config["index_file"] + '.tmp', 'w') as f:
+        f.writelines(lines)
+    os.replace(resolver.config["index_file"] + '.tmp', resolver.config["index_file"])
+    hashes = dict((core, h) for core, (_, h, _) in resolver.index_entries.items())
+    details = dict((core, d) for core, (_, _, d) in resolver.index_entries.items())
+    for kind, found in (("registers", hashes), ("details", details)):
+        for core, h in load_hashes(resolver.config["hash_file"], kind).items():
+            if core in cores and core not in found:
+                found[core] = h
+    write_hashes(resolver.config["hash_file"], hashes, details)
+
+def index_key(term):
+    # offsets are indexed as 0x%08x
+    n = parse_int(term) if term[:2].lower() == '0x' else None
+    return ('0x%08x' % n if n is not None else term).lower().encode()
+
+def index_lookup(mm, key, prefix=False):
+    lo, hi = 0, len(mm)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = mm.rfind(b'\n', 0, mid) + 1
+        end = mm.find(b'\n', start) + 1 or len(mm)
+        if mm[start:mm.find(b'\t', start)] < key:
+            lo = end
+        else:
+            hi = start
+    while lo < len(mm):
+        end = mm.find(b'\n', lo) + 1 or len(mm)
+        line = mm[lo:end].decode().rstrip('\n').split('\t')
+        if not (line[0].startswith(key.decode()) if prefix else line[0] == key.decode()):
+            break
+        yield line[1:]
+        lo = end
+
+def query(args):
+    try:
+        f = open(os.path.join(os.path.normpath(args.out), 'registers.idx'), 'rb')
+    except OSError as err:
+        sys.exit("no register index, run ads2svd.py with --index first : %s" % err)
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 1
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        found = 0
+        for term in args.term:
+            for kind, key, core, flt, rlist, periph, reg in index_lookup(mm, index_key(term), args.prefix):
+                if args.kind and kind not in args.kind:
+                    continue
+                print('\t'.join((core, flt, rlist, periph, reg, '%s=%s' % (kind, key))))
+                found += 1
+        mm.close()
+    return 0 if found else 1
+
+# structural diff : every register and field of the model gets a hash of its
+# canonical content (descriptions left out unless asked), registers are matched
+# by reg_filter/peripheral (or register_group)/name and only the ones whose hash differs are opened
+def short_hash(value):
+    return hashlib.sha1(repr(value).encode()).hexdigest()[:16]
+
+def field_hash(f, descriptions=False):
+    enum = f.enumeration.items if f.enumeration is not None else None
+    return short_hash((f.name, f.ranges, f.access, enum, f.description if descriptions else None))
+
+def register_hashes(core, descriptions=False):
+    # key -> (hash, {field name : hash}, register)
+    filter_names = dict((fid, name) for name, fid in core.filters.items())
+    res = {}
+    for rlist in core.register_lists:
+        flt = filter_names.get(rlist.filter, rlist.filter) or ''
+        for p, regs in [(None, rlist.registers)] + [(p, p.registers) for p in rlist.peripherals]:
+            for reg in regs:
+                # the same register can be listed in several register_groups
+                where = p.name if p else reg.group or ''
+                key = '/'.join((flt, where, reg.name))
+                n = 1
+                while key in res:
+                    n += 1
+                    key = '/'.join((flt, where, '%s#%d' % (reg.name, n)))
+                fields = dict((f.name, field_hash(f, descriptions)) for f in reg.fields)
+                res[key] = (short_hash((reg.name, reg.offset, reg.size, reg.access, sorted(fields.items()),
+                                        reg.description if descriptions else None)), fields, reg)
+    return res
+
+def register_details(core, descriptions=False):
+    # key -> [hash, {field name : hash}, offset, size, access(, description)] : what
+    # a two core diff prints, without the model
+    return dict((k, [h, fields, reg.offset, reg.size, reg.access] + ([reg.description] if descriptions else []))
+                for k, (h, fields, reg) in register_hashes(core, descriptions).items())
+
+# out/registers.hash : two json lines per core, {"core", "registers" : {key : hash}}
+# for diff -a and {"core", "details" : register_details} for a two core diff. A line
+# of the other kind or of another core is skipped without parsing it
+hash_line = re.compile(rb'\{"core": ("(?:[^"\\]|\\.)*"), "(\w+)": ')
+
+def load_hashes(path, kind="registers", cores=None):
+    hashes = {}
+    try:
+        with open(path, 'rb') as f:
+            for line in f:
+                m = hash_line.match(line)
+                if m is None or m.group(2).decode() != kind or (cores is not None and json.loads(m.group(1)) not in cores):
+                    continue
+                entry = json.loads(line)
+                hashes[entry["core"]] = entry[kind]
+    except (OSError, ValueError):
+        pass
+    return hashes
+
+def write_hashes(path, hashes, details):
+    with open(path + '.tmp', 'w') as f:
+        for core in sorted(hashes):
+            f.write(json.dumps({"core" : core, "registers" : hashes[core]}, sort_keys=True) + '\n')
+            if core in details:
+                f.write(json.dumps({"core" : core, "details" : details[core]}, sort_keys=True) + '\n')
+    os.replace(path + '.tmp', path)
+
+def load_resolved(out_dir, core):
+    # the snapshot when there is one, else the intermediate xml
+    snap = os.path.join(out_dir, 'cores.snap')
+    if os.path.isfile(snap):
+        snapshot = Snapshot(snap)
+        try:
+            if core in snapshot.index:
+                return snapshot.model(core)
+        finally:
+            snapshot.close()
+    return build_core(etree.ElementTree(etree.fromstring(read_output(os.path.join(out_dir, core + '.xml')), rawparser)), core)
+
+def diff_hashes(a, b):
+    # keys added, removed and changed between two {key : hash}
+    return (sorted(k for k in b if k not in a), sorted(k for k in a if k not in b),
+            sorted(k for k in a if k in b and a[k] != b[k]))
+
+def diff_cores(args):
+    if args.all:
+        hashes = load_hashes(os.path.join(os.path.normpath(args.out), 'registers.hash'))
+        if args.core[0] not in hashes:
+            sys.exit("%s is not in %s/registers.hash, run ads2svd.py with --index first" % (args.core[0], args.out))
+        if args.descriptions:
+            # registers.hash leaves the descriptions out : hash the resolved cores again, like a two core diff -d
+            hashes = dict((c, dict((k, v[0]) for k, v in register_hashes(load_resolved(os.path.normpath(args.out), c), True).items()))
+                          for c in sorted(hashes))
+        ref = hashes[args.core[0]]
+        for core in sorted(hashes):
+            if core == args.core[0]:
+                continue
+            added, removed, changed = diff_hashes(ref, hashes[core])
+            same = len(ref) - len(removed) - len(changed)
+            print('%-32s +%-5d -%-5d ~%-5d =%d' % (core, len(added), len(removed), len(changed), same))
+        return 0
+    if len(args.core) != 2:
+        sys.exit("diff takes two cores, or one with --all")
+    # registers.hash has them (but the descriptions) : the resolved cores are not opened
+    details = {} if args.descriptions else load_hashes(os.path.join(os.path.normpath(args.out), 'registers.hash'), "details", args.core)
+    a, b = [details[c] if c in details else register_details(load_resolved(os.path.normpath(args.out), c), args.descriptions)
+            for c in args.core]
+    added, removed, changed = diff_hashes(dict((k, v[0]) for k, v in a.items()), dict((k, v[0]) for k, v in b.items()))
+    for k in added:
+        print('+ %s' % k)
+    for k in removed:
+        print('- %s' % k)
+    for k in changed:
+        what = ['%s %s -> %s' % (attr, va, vb) for attr, va, vb in zip(('offset', 'size', 'access', 'description'), a[k][2:], b[k][2:]) if va != vb]
+        fadded, fremoved, fchanged = diff_hashes(a[k][1], b[k][1])
+        what += ['+%s' % f for f in fadded] + ['-%s' % f for f in fremoved] + ['~%s' % f for f in fchanged]
+        print('~ %s : %s' % (k, ', '.join(what)))
+    print('%d added, %d removed, %d changed, %d identical' % (len(added), len(removed), len(changed), len(a) - len(removed) - len(changed)))
+    return 1 if added or removed or changed else 0
+
+def update_snapshot(resolver):
+    if resolver.config["snapshot"] is not None:
+        write_snapshot(resolver.config["out_dir"], resolver.config["snapshot"] or os.path.join(resolver.config["out_dir"], 'cores.snap'))
+
+# --watch : the process stays up with its schema and include caches, a change
+# under the configdb only redoes the cores whose include graph has the file
+# an edit is seen once the file is closed (IN_CLOSE_WRITE), not on every write
+IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x8, 0x40, 0x80, 0x100, 0x200
+IN_ISDIR = 0x40000000
+inotify_event = struct.Struct('iIII')
+
+def inotify_changes(top):
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+    fd = libc.inotify_init1(os.O_CLOEXEC)
+    if fd < 0:
+        raise OSError(ctypes.get_errno(), "inotify_init1")
+    dirs = {}
+    def add(d):
+        for sub, _, _ in os.walk(d):
+            wd = libc.inotify_add_watch(fd, sub.encode(), IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch %s" % sub)
+            dirs[wd] = sub
+    add(top)
+    return inotify_events(fd, dirs, add)
+
+def inotify_events(fd, dirs, add):
+    while True:
+        changed = set()
+        # an editor save is a burst of events, wait for it to settle
+        while select.select([fd], [], [], None if not changed else 0.05)[0]:
+            buf = os.read(fd, 65536)
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, size = inotify_event.unpack_from(buf, pos)
+                name = buf[pos + inotify_event.size:pos + inotify_event.size + size].rstrip(b'\0').decode()
+                pos += inotify_event.size + size
+                if wd not in dirs or not name:
+                    continue
+                path = os.path.join(dirs[wd], name)
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        add(path)
+                        changed.update(os.path.join(d, f) for d, _, files in os.walk(path) for f in files)
+                elif not (mask & IN_CREATE):
+                    # a created file is reported again once written
+                    changed.add(path)
+        yield changed
+
+def scan_mtimes(top):
+    mtimes = {}
+    for d, _, files in os.walk(top):
+        for f in files:
+            try:
+                mtimes[os.path.join(d, f)] = os.stat(os.path.join(d, f)).st_mtime_ns
+            except OSError:
+                # deleted since the walk listed it : the next scan sees it gone
+                pass
+    return mtimes
+
+def poll_changes(top):
+    # no inotify : compare the mtimes every half second, from the ones of now
+    return poll_events(top, scan_mtimes(top))
+
+def poll_events(top, before):
+    while True:
+        time.sleep(0.5)
+        now = scan_mtimes(top)
+        changed = set(p for p in set(before) | set(now) if before.get(p) != now.get(p))
+        before = now
+        if changed:
+            yield changed
+
+def forget(resolver, paths):
+    # drop the cached parses of the changed files and of every file including them
+    parents = {}
+    for p, deps in resolver.include_deps.items():
+        for d in deps:
+            parents.setdefault(d, set()).add(p)
+    todo = list(paths)
+    stale = set()
+    while todo:
+        p = todo.pop()
+        if p in stale:
+            continue
+        stale.add(p)
+        todo.extend(parents.get(p, ()))
+    for p in stale:
+        resolver.include_docs.pop(p, None)
+        resolver.include_deps.pop(p, None)
+        resolver.file_hashes.pop(p, None)
+    # a new file can be the fix of a failed include or a better repair
+    resolver.configdb_files = None
+    resolver.include_failures.clear()
+    for key in resolver.include_repairs:
+        resolver.include_results.pop(key, None)
+    resolver.include_repairs.clear()
+    for key in [k for k in resolver.include_results if k[0] in stale]:
+        del resolver.include_results[key]
+
+def watch_changes(resolver):
+    # set up before the first build, a file saved during it is redone after
+    try:
+        return inotify_changes(resolver.config["configdb_path"])
+    except (OSError, AttributeError) as err:
+        sys.stderr.write("inotify not available (%s), polling\n" % err)
+        return poll_changes(resolver.config["configdb_path"])
+
+def rewrite_logs(resolver, xmls_cores):
+    # the logs of the last resolve of every core, in core order (an include shared
+    # by several cores is reported once)
+    names = [x.split(os.path.sep)[-1][:-4] for x in xmls_cores]
+    with open(resolver.config["xinclude_error_log"], "w") as f:
+        for name in names:
+            f.writelines(resolver.errors.get(name, ()))
+    seen = set()
+    with open(resolver.config["validation_log"], "w") as f:
+        for name in names:
+            lines = [l for l in resolver.invalid.get(name, ()) if l not in seen]
+            seen.update(lines)
+            f.writelines(lines)
+
+def watch(resolver, xmls_cores, all_cores, changes):
+    # absolute paths from now on, the include caches are keyed by the paths they come from
+    xmls_cores = [os.path.abspath(x) for x in xmls_cores]
+    print("watching %s" % resolver.config["configdb_path"])
+    for changed in changes:
+        t = time.perf_counter()
+        changed = set(os.path.abspath(p) for p in changed)
+        forget(resolver, changed)
+        manifest = load_manifest(resolver.config["manifest"])
+        if any(p.endswith('.xsd') for p in changed):
+            if resolver.config["validate"] != "off":
+                build_schema_wrapper(resolver)
+            resolver.validated.clear()
+            todo = list(xmls_cores)
+        else:
+            rel = set(os.path.relpath(p, resolver.config["configdb_path"]) for p in changed)
+            if all_cores:
+                xmls_cores = sorted(set(xmls_cores) | set(p for p in changed if os.path.dirname(p) == os.path.normpath(resolver.config["configdb_cores_path"]) and p.endswith('.xml') and os.path.isfile(p)))
+            xmls_cores = [x for x in xmls_cores if os.path.isfile(x)]
+            todo = [x for x in xmls_cores if x in changed or x.split(os.path.sep)[-1] not in manifest
+                    or rel & set(manifest[x.split(os.path.sep)[-1]]["deps"])]
+        if not todo:
+            continue
+        resolver.reported_invalid.clear()
+        resolver.index_entries.clear()
+        for x in todo:
+            try:
+                loadxml(resolver, x, manifest, None)
+            except (OSError, etree.XMLSyntaxError) as err:
+                # half saved file : report it and wait for the next change
+                sys.stderr.write("%s : %s\n" % (x, err))
+        done_loading(resolver, manifest, None)
+        rewrite_logs(resolver, xmls_cores)
+        update_snapshot(resolver)
+        print("%d core(s) redone in %.3fs" % (len(todo), time.perf_counter() - t))
+        sys.stdout.flush()
+
+# a Resolver holds the config of one configdb and its caches, kept between calls :
+# every function above that resolves or writes takes it as its first argument.
+# From python, a Resolver's calls run one at a time, several Resolvers can be used
+# side by side from several threads.
+class Resolver(object):
+    def __init__(self, configdb, **options):
+        # options are the command line ones by their long name : out, validate, svd, index...
+        args = argparser.parse_args(['-c', configdb])
+        for k, v in options.items():
+            if not hasattr(args, k):
+                raise TypeError("unknown option %s" % k)
+            setattr(args, k, v)
+        self.setup(config_from_args(args))
+
+    @classmethod
+    def from_config(cls, cfg):
+        # a worker process : the config of the parent, caches of its own
+        self = cls.__new__(cls)
+        self.setup(cfg)
+        return self
+
+    def setup(self, cfg):
+        self.config = cfg
+        # a parser is not shared between threads. The schema is only built on the first validation
+        self.parser = etree.XMLParser(remove_blank_text=True)
+        self.schema = None
+        # shared by every core : parsed include targets by absolute path, compiled
+        # selectors and resolved (nested includes done) results by (path, xpointer)
+        self.include_docs = {}
+        self.include_selectors = {}
+        self.include_results = {}
+        # include failures by (path, xpointer), never tried again, and --repair : the
+        # file a missing target was found at by (path, xpointer), the repairs not
+        # reported yet, and the files of the configdb by lower case name and stem
+        self.include_failures = {}
+        self.include_repairs = {}
+        self.new_repairs = []
+        self.configdb_files = None
+        self.reported_repairs = set()
+        # include graph : direct include targets of every parsed file, and content hashes
+        self.include_deps = {}
+        self.file_hashes = {}
+        # --validate once : schema errors of every validated source file by content hash,
+        # kept across runs in out/validated.json
+        self.validated = {}
+        self.reported_invalid = set()
+        # --index : register index lines and register hashes of the cores resolved by
+        # the run, by core name
+        self.index_entries = {}
+        # the cores of the run whose resolve raised, reported on stderr and left out
+        self.failed_cores = []
+        # --store : the outputs as out/objects/<sha1[:2]>/<sha1>.gz, out/store.json maps their
+        # file names to the hashes. store_index is that map, store_entries what this
+        # process wrote for the core being resolved
+        self.store_index = {}
+        self.store_entries = {}
+        # serve workers : stat of the files behind the include caches when they were read
+        self.include_stats = {}
+        # xinclude_error.log and validation.log lines of the last resolve of every core, by core name
+        self.errors = {}
+        self.invalid = {}
+        self.lock = threading.RLock()
+
+    def core_path(self, core):
+        # a path, or a core name of the configdb (Cortex-M4 or Cortex-M4.xml)
+        if os.path.isfile(core):
+            return os.path.abspath(core)
+        if not core.endswith('.xml'):
+            core += '.xml'
+        return os.path.join(self.config["configdb_cores_path"], core)
+
+    def cores(self):
+        return sorted(glob.glob(os.path.join(self.config["configdb_cores_path"], "*.xml")))
+
+    def resolve(self, core, as_bytes=False):
+        # the resolved tree, or the bytes ads2svd.py writes to out/
+        p = self.core_path(core)
+        with self.lock:
+            root, errors, _ = resolve_tree(self, p, core_stats(p))
+        self.errors[p.split(os.path.sep)[-1][:-4]] = errors
+        if as_bytes:
+            return etree.tostring(root, pretty_print=True)
+        return root
+
+    def model(self, core):
+        p = self.core_path(core)
+        return build_core(self.resolve(p), p.split(os.path.sep)[-1][:-4])
+
+    def svd(self, core):
+        # {svd file name : device element} of the files --svd writes (but the empty one)
+        p = self.core_path(core)
+        devices = {}
+        for path, device in svd_outputs(self.resolve(p), p.split(os.path.sep)[-1][:-4]):
+            if device is not None:
+                if self.config["derive"]:
+                    derive_device(device)
+                devices[path] = device
+        return devices
+
+    def build(self, cores=None):
+        # what the command line does : write the outputs of the cores to the out directory
+        with self.lock:
+            prepare_out(self)
+            loadxmls(self, cores if cores is not None else self.cores())
+            update_snapshot(self)
+
+    def forget(self, paths):
+        # changed files : their cached parses and those of every file including them go
+        with self.lock:
+            forget(self, [os.path.abspath(p) for p in paths])
+
+# ads2svd.py serve : the cores over http, resolved and emitted on the first request.
+# GET /cores lists them, /cores/X.xml is the resolved core, /cores/X.svd or
+# /cores/X/<reg_filter>.svd the svds, /cores/X.json, /cores/X.h or /cores/X/<reg_filter>.h
+# the model outputs. The results stay in a LRU bounded in bytes and keyed by the
+# content hash of the include graph, so an edit under the configdb is seen by the
+# next request. Cold requests run on worker processes, a request for a key being
+# built waits for that build.
+SERVE_TYPES = {'xml' : 'application/xml', 'svd' : 'application/xml', 'json' : 'application/json', 'h' : 'text/x-c'}
+def file_stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def refresh_includes(resolver):
+    # worker side : the cached parses and hashes of the files changed since go
+    changed = [p for p in list(resolver.include_stats) if file_stat(p) != resolver.include_stats[p]]
+    for p in changed:
+        del resolver.include_stats[p]
+    if changed:
+        forget(resolver, changed)
+
+def serve_job(p, kind):
+    # on the serve workers, with the Resolver of the process
+    resolver = worker
+    refresh_includes(resolver)
+    name = p.split(os.path.sep)[-1][:-4]
+    root, errors, direct = resolve_tree(resolver, p, core_stats(p))
+    deps = core_deps(resolver, p, direct)
+    outputs = {}
+    if kind == 'xml':
+        outputs[name + '.xml'] = etree.tostring(root, pretty_print=True)
+    elif kind == 'svd':
+        for path, device in svd_outputs(root, name):
+            if device is not None:
+                if resolver.config["derive"]:
+                    derive_device(device)
+                outputs[path] = etree.tostring(device, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+    else:
+        core = build_core(root, name)
+        if kind == 'json':
+            outputs[name + '.json'] = json.dumps(core_json(core), separators=(',', ':')).encode()
+        else:
+            for reg_filter in sorted(core.filters) or [None]:
+                outputs[name + ('_' + reg_filter if reg_filter is not None else '') + '.h'] = c_header(core, reg_filter).encode()
+    for d in list(resolver.include_docs) + deps:
+        if d not in resolver.include_stats:
+            resolver.include_stats[d] = file_stat(d)
+    return dict((d, file_hash(resolver, d)) for d in deps), outputs, len(errors)
+
+class CoreCache(object):
+    def __init__(self, cfg, max_bytes, jobs):
+        self.max_bytes = max_bytes
+        self.size = 0
+        # (graph hash, kind) : (outputs, failed includes), oldest first
+        self.lru = collections.OrderedDict()
+        # (core path, graph hash, kind) : future of the build
+        self.running = {}
+        # core path : its include graph at the last build, file : (stat, sha1)
+        self.deps = {}
+        self.hashes = {}
+        self.lock = threading.Lock()
+        self.pool = concurrent.futures.ProcessPoolExecutor(jobs, multiprocessing.get_context('forkserver'), init_worker, (cfg, {}))
+
+    def content_hash(self, path):
+        st = file_stat(path)
+        known = self.hashes.get(path)
+        if known is None or known[0] != st:
+            known = (st, None)
+            if st is not None:
+                with open(path, 'rb') as f:
+                    known = (st, hashlib.sha1(f.read()).hexdigest())
+            self.hashes[path] = known
+        return known[1]
+
+    def graph_hash(self, deps):
+        h = hashlib.sha1()
+        for d in sorted(deps):
+            h.update(('%s %s\n' % (d, self.content_hash(d))).encode())
+        return h.hexdigest()
+
+    def get(self, p, kind):
+        deps = self.deps.get(p)
+        key = (self.graph_hash(deps) if deps else None, kind)
+        with self.lock:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+                return self.lru[key]
+            job = self.running.get((p,) + key)
+            if job is None:
+                job = self.running[(p,) + key] = self.pool.submit(serve_job, p, kind)
+        try:
+            hashes, outputs, nfail = job.result()
+        finally:
+            with self.lock:
+                self.running.pop((p,) + key, None)
+        # a file saved while the worker read it : serve the result but don't keep it
+        if any(self.content_hash(d) != h for d, h in hashes.items()):
+            return outputs, nfail
+        self.deps[p] = list(hashes)
+        key = (self.graph_hash(hashes), kind)
+        with self.lock:
+            if key not in self.lru:
+                self.lru[key] = (outputs, nfail)
+                self.size += sum(len(v) for v in outputs.values())
+            while self.size > self.max_bytes and len(self.lru) > 1:
+                _, (old, _) = self.lru.popitem(last=False)
+                self.size -= sum(len(v) for v in old.values())
+        return outputs, nfail
+
+class ServeHandler(http.server.BaseHTTPRequestHandler):
+    def reply(self, code, ctype, data, headers=()):
+        self.send_response(code)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        parts = [urllib.parse.unquote(x) for x in urllib.parse.urlsplit(self.path).path.split('/') if x]
+        cores_path = self.server.cores_path
+        if parts == ['cores']:
+            names = sorted(x.split(os.path.sep)[-1][:-4] for x in glob.glob(os.path.join(cores_path, "*.xml")))
+            return self.reply(200, 'text/plain', ''.join(n + '\n' for n in names).encode())
+        if len(parts) not in (2, 3) or parts[0] != 'cores' or '.' not in parts[-1]:
+            return self.reply(404, 'text/plain', b'GET /cores, /cores/X.xml, /cores/X.svd, /cores/X/<reg_filter>.svd, /cores/X.json, /cores/X.h or /cores/X/<reg_filter>.h\n')
+        base, kind = parts[-1].rsplit('.', 1)
+        core = parts[1] if len(parts) == 3 else base
+        p = os.path.join(cores_path, core + '.xml')
+        if kind not in SERVE_TYPES or os.path.sep in core or not os.path.isfile(p):
+            return self.reply(404, 'text/plain', ('no core %s or no .%s output\n' % (core, kind)).encode())
+        try:
+            outputs, nfail = self.server.cache.get(p, kind)
+        except Exception as err:
+            return self.reply(500, 'text/plain', ('%s : %s\n' % (core, err)).encode())
+        name = (core + '_' + base if len(parts) == 3 else base) + '.' + kind
+        if name not in outputs:
+            return self.reply(404, 'text/plain', ('no %s, %s has %s\n' % (name, core, ' '.join(sorted(outputs)))).encode())
+        self.reply(200, SERVE_TYPES[kind], outputs[name], [('X-Failed-Includes', str(nfail))])
+
+def serve(args):
+    cfg = Resolver(args.configdb, validate='off', derive=args.derive).config
+    server = http.server.ThreadingHTTPServer((args.bind, args.port), ServeHandler)
+    server.cores_path = cfg["configdb_cores_path"]
+    server.cache = CoreCache(cfg, args.cache_size << 20, args.jobs or os.cpu_count())
+    print("serving %s on http://%s:%d/cores" % (cfg["configdb_path"], args.bind, server.server_address[1]))
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.cache.pool.shutdown(cancel_futures=True)
+    return 0
+
+def get_dev(resolver):
+    error_log = open(resolver.config["xinclude_error_log"],"w+")
     error_log.close()
     xmls_cores = [
         'Cortex-M0.xml',
         'Cortex-M4.xml',
         'Cortex-A72.xml',
     ]
-    for x in xmls_cores:
-        loadxml(config["configdb_cores_path"] +"/" + x)
+    loadxmls(resolver, [resolver.config["configdb_cores_path"] +"/" + x for x in xmls_cores])
 
-def get_all():
-    error_log = open(config["xinclude_error_log"],"w+")
+def get_all(resolver):
+    error_log = open(resolver.config["xinclude_error_log"],"w+")
     error_log.close()
-    xmls_cores = [ x for x in sorted(glob.glob(   os.path.join(config["configdb_cores_path"] , "*.xml")))]
-    for x in xmls_cores:
-        loadxml(x)     
-        
+    xmls_cores = [ x for x in sorted(glob.glob(   os.path.join(resolver.config["configdb_cores_path"] , "*.xml")))]
+    xmls_cores = shard_cores(resolver, xmls_cores)
+    loadxmls(resolver, xmls_cores)
+    return xmls_cores
+
+# --shard i/n : every build node gets the same cost estimates (they only depend on
+# the configdb and on the --costs file), so they all agree on the partition
+# without talking to each other. ads2svd.py merge puts the shard outputs back together.
+href_attr = re.compile(rb'href="([^"#]+)')
+
+def include_sizes(p, sizes, hrefs):
+    # bytes of the core and of every file it includes, with a cheap href scan
+    seen = set()
+    todo = [os.path.abspath(p)]
+    total = 0
+    while todo:
+        d = todo.pop()
+        if d in seen:
+            continue
+        seen.add(d)
+        if d not in sizes:
+            try:
+                with open(d, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = b''
+            sizes[d] = len(data)
+            hrefs[d] = [os.path.normpath(os.path.join(os.path.dirname(d), h.decode())) for h in href_attr.findall(data)]
+        total += sizes[d]
+        todo.extend(hrefs[d])
+    return total
+
+def load_costs(path):
+    # seconds per core from an earlier --stats file
+    costs = {}
+    with open(path) as f:
+        for line in f:
+            entry = json.loads(line)
+            if not entry.get("summary"):
+                costs[entry["core"]] = sum(entry[k] for k in ("parse", "xinclude", "failures", "serialize", "svd", "emit", "depfile", "validate", "index"))
+    return costs
+
+def core_costs(xmls_cores, costs_file=None):
+    sizes, hrefs = {}, {}
+    costs = dict((x, include_sizes(x, sizes, hrefs)) for x in xmls_cores)
+    if costs_file:
+        timed = load_costs(costs_file)
+        known = [x for x in xmls_cores if x.split(os.path.sep)[-1] in timed and costs[x]]
+        # the cores missing from the file are priced in seconds from their size
+        rate = sorted(timed[x.split(os.path.sep)[-1]] / costs[x] for x in known)[len(known) // 2] if known else 1.0
+        costs = dict((x, timed.get(x.split(os.path.sep)[-1], costs[x] * rate)) for x in xmls_cores)
+    return costs
+
+def shards(xmls_cores, n, costs_file=None):
+    # longest first on the least loaded shard, ties by name so every node gets the same answer
+    costs = core_costs(xmls_cores, costs_file)
+    loads = [0.0] * n
+    shard_of = {}
+    for x in sorted(xmls_cores, key=lambda x: (-costs[x], x.split(os.path.sep)[-1])):
+        i = loads.index(min(loads))
+        loads[i] += costs[x]
+        shard_of[x] = i
+    return shard_of, loads
+
+def shard_cores(resolver, xmls_cores):
+    if not resolver.config["shard"]:
+        return xmls_cores
+    i, n = resolver.config["shard"]
+    shard_of, loads = shards(xmls_cores, n, resolver.config["costs"])
+    sys.stderr.write("shard %d/%d : %d of %d cores, estimated cost %.3g of %.3g\n" % (
+        i, n, sum(1 for x in xmls_cores if shard_of[x] == i - 1), len(xmls_cores), loads[i - 1], sum(loads)))
+    return [x for x in xmls_cores if shard_of[x] == i - 1]
+
+def shard_arg(s):
+    m = re.match(r'^(\d+)/(\d+)$', s)
+    if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+        raise argparse.ArgumentTypeError("expected i/n with 1 <= i <= n, got %r" % s)
+    return int(m.group(1)), int(m.group(2))
+
+# files of a run that merge combines, everything else in a shard output is per core
+RUN_FILES = ('xinclude_error.log', 'validation.log', 'include_repairs.log', 'manifest.json', 'validated.json',
+             'registers.idx', 'registers.hash', 'cores.snap', '.resolved', 'store.json')
+
+def merge_data(src, dst):
+    with open(src, 'rb') as f:
+        data = f.read()
+    if src.endswith('.d'):
+        # the make targets are in the shard directory, they move next to dst
+        targets, rest = data.split(b': ', 1)
+        data = b'%s: %s' % (b' '.join(os.path.join(os.path.dirname(dst), t.decode().split(os.path.sep)[-1]).encode() for t in targets.split()), rest)
+    return data
+
+def add_merge_file(files, src, dst):
+    # the shards have disjoint cores, the same file in two shards must be the same
+    # file. What the out directory holds from an earlier run is overwritten
+    if dst in files:
+        if merge_data(files[dst], dst) != merge_data(src, dst):
+            raise ValueError("%s and %s differ" % (files[dst], src))
+        return
+    files[dst] = src
+
+def merge_file(src, dst):
+    with open(dst + '.tmp', 'wb') as f:
+        f.write(merge_data(src, dst))
+    os.replace(dst + '.tmp', dst)
+
+def read_lines(path):
+    try:
+        with open(path) as f:
+            return f.readlines()
+    except OSError:
+        return []
+
+def merge_shards(args):
+    out_dir = os.path.normpath(args.out)
+    if not os.path.isdir(out_dir):
+        os.mkdir(out_dir)
+    manifest = {}
+    store = {}
+    repairs = {}
+    errors = {}
+    invalid = set()
+    index = set()
+    hashes = {}
+    details = {}
+    validated_files = {}
+    schemas = set()
+    snapshot = False
+    # destination : source, nothing is written before every shard is checked
+    files = {}
+    try:
+        for d in args.shard:
+            for name in sorted(os.listdir(d)):
+                if name not in RUN_FILES and not name.endswith('.tmp') and os.path.isfile(os.path.join(d, name)):
+                    add_merge_file(files, os.path.join(d, name), os.path.join(out_dir, name))
+            for obj in sorted(glob.glob(os.path.join(d, 'objects', '*', '*.gz'))):
+                # named by their content, the first shard's copy is as good as any
+                files.setdefault(os.path.join(out_dir, os.path.relpath(obj, d)), obj)
+            for name, h in load_store(d).items():
+                if store.setdefault(name, h) != h:
+                    raise ValueError("%s is stored differently by two shards" % name)
+            try:
+                with open(os.path.join(d, 'manifest.json')) as f:
+                    part = json.load(f)
+            except (OSError, ValueError):
+                part = {}
+            for core, deps in part.items():
+                if manifest.setdefault(core, deps) != deps:
+                    raise ValueError("%s was resolved differently by two shards" % core)
+            # error lines are grouped by core, the cores in file name order like -a
+            for line in read_lines(os.path.join(d, 'xinclude_error.log')):
+                m = re.search(r';file="([^"]*)"', line)
+                errors.setdefault(m.group(1) if m else '', []).append(line)
+            invalid.update(read_lines(os.path.join(d, 'validation.log')))
+            for line in read_lines(os.path.join(d, 'include_repairs.log')):
+                key = line[:line.index(';core=')]
+                repairs[key] = min(repairs.get(key, line), line, key=lambda l: l[l.index(';core='):])
+            index.update(read_lines(os.path.join(d, 'registers.idx')))
+            hashes.update(load_hashes(os.path.join(d, 'registers.hash')))
+            details.update(load_hashes(os.path.join(d, 'registers.hash'), "details"))
+            try:
+                with open(os.path.join(d, 'validated.json')) as f:
+                    cache = json.load(f)
+                schemas.add(cache["schema"])
+                validated_files.update(cache["files"])
+            except (OSError, ValueError, KeyError):
+                pass
+            snapshot = snapshot or os.path.isfile(os.path.join(d, 'cores.snap'))
+    except ValueError as err:
+        sys.stderr.write("merge failed : %s\n" % err)
+        return 1
+    for dst, src in sorted(files.items()):
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        merge_file(src, dst)
+    save_manifest(os.path.join(out_dir, 'manifest.json'), manifest)
+    if store:
+        with open(os.path.join(out_dir, 'store.json'), 'w') as f:
+            json.dump(store, f, indent=1, sort_keys=True)
+    with open(os.path.join(out_dir, 'xinclude_error.log'), 'w') as f:
+        for core in sorted(errors):
+            f.writelines(errors[core])
+    with open(os.path.join(out_dir, 'validation.log'), 'w') as f:
+        f.writelines(sorted(invalid))
+    if repairs:
+        # by core, in file name order like -a
+        with open(os.path.join(out_dir, 'include_repairs.log'), 'w') as f:
+            f.writelines(sorted(repairs.values(), key=lambda l: (l[l.index(';core='):], l)))
+    if index or hashes:
+        with open(os.path.join(out_dir, 'registers.idx'), 'w') as f:
+            f.writelines(sorted(index))
+        write_hashes(os.path.join(out_dir, 'registers.hash'), hashes, details)
+    if len(schemas) == 1:
+        with open(os.path.join(out_dir, 'validated.json'), 'w') as f:
+            json.dump({"schema" : schemas.pop(), "files" : validated_files}, f, sort_keys=True)
+    if snapshot:
+        write_snapshot(out_dir, os.path.join(out_dir, 'cores.snap'))
+    print("%d cores from %d shards in %s" % (len(manifest), len(args.shard), out_dir))
+    return 0
 
 
 argparser = argparse.ArgumentParser()
 argparser.add_argument('-c', '--configdb', required=True, help="Base path for the DS configdb folder.")
 argparser.add_argument('-o', '--out'     , default="./out/", help="Output directory path (defaults to 'out').")
 argparser.add_argument('-a', '--all'     , action='store_true' , help="Process all xml files in configdb/Cores/ (default).")
-argparser.add_argument('-i', '--infile'      , default=False, help="Process an xml file.")
+argparser.add_argument('-i', '--infile'  , nargs='+', action='extend', default=[], help="Process xml files ('-' reads the list from stdin).")
+argparser.add_argument('-j', '--jobs'    , type=int, default=None, help="Number of worker processes (defaults to 1, or to the make jobserver slots, 0 for one per cpu).")
+argparser.add_argument('-s', '--stale'   , action='store_true' , help="Only process the cores with an output asked for missing or made without the options asked for, or whose included files changed (out/manifest.json).")
+argparser.add_argument('--svd'          , action='store_true' , help="Also generate the svd files with the python emitter (no saxon needed).")
+argparser.add_argument('--derive'       , action='store_true' , help="With --svd, write repeated peripherals, registers and enumeratedValues once and derivedFrom it elsewhere.")
+argparser.add_argument('--header'       , action='store_true' , help="Also write a C header of register offsets, bit field positions/masks and enumerated values (one per reg_filter, like the svds).")
+argparser.add_argument('--json'         , action='store_true' , help="Also write the registers of every core as json.")
+argparser.add_argument('--export'       , choices=('json', 'binary'), action='append', help="Also write the registers as string and integer tables, X.min.json or X.regs (binary), for ads2svd.load_export (can be given twice).")
+argparser.add_argument('--check'        , default=None, help="Compare the generated svd files with the (saxon) ones in this directory.")
+argparser.add_argument('--validate'     , choices=('off', 'once', 'full'), default='once', help="Schema validation : off, once (every source file, cached by content in out/validated.json, default) or full (the resolved document). Problems go to out/validation.log.")
+argparser.add_argument('--snapshot'     , nargs='?', const='', default=None, help="Also pack every resolved core of the output directory in one mmap-able file with an index (defaults to out/cores.snap).")
+argparser.add_argument('--index'        , action='store_true' , help="Also index the registers by name, gui_name, field and offset in out/registers.idx (see ads2svd.py query).")
+argparser.add_argument('-w', '--watch'   , action='store_true' , help="Then keep running and redo the cores whose include graph has a file changed under the configdb (inotify).")
+argparser.add_argument('--shard'        , type=shard_arg, default=None, help="Only process the i-th of n cost balanced shards of the cores (i/n, 1 <= i <= n), see ads2svd.py merge.")
+argparser.add_argument('--costs'        , default=None, help="With --shard, the per core times of an earlier --stats file instead of the included bytes.")
+argparser.add_argument('--store'        , action='store_true' , help="Write the outputs gzipped and named by content hash in out/objects/, out/store.json maps the file names to them (identical outputs are stored once).")
+argparser.add_argument('--repair'       , action='store_true' , help="Look a missing include target up in every file of the configdb (same name in another directory, other case, .xml for .inc and back) and use the closest one that the xpointer finds nodes in. Repairs go to out/include_repairs.log.")
+argparser.add_argument('--max-memory'   , type=int, default=None, help="Memory budget of the run in MB : a process past its share (the budget over -j) drops its cache of parsed includes before the next core.")
+argparser.add_argument('--stats'        , default=None, help="Write per core stage timings and counters to this file (json lines, last line is the summary).")
 
-args = argparser.parse_args()
+queryparser = argparse.ArgumentParser(prog='ads2svd.py query', description="Look registers up in the index of ads2svd.py --index, prints core, reg_filter, register_list, peripheral, register and the matched key.")
+queryparser.add_argument('term'          , nargs='+', help="Register name, gui_name, field name or offset (0x...), case insensitive.")
+queryparser.add_argument('-o', '--out'   , default="./out/", help="Output directory of the indexing run (defaults to 'out').")
+queryparser.add_argument('-p', '--prefix', action='store_true', help="Match the keys starting with the terms.")
+queryparser.add_argument('-k', '--kind'  , nargs='+', action='extend', choices=INDEX_KINDS, help="Only match these kinds of keys.")
 
+diffparser = argparse.ArgumentParser(prog='ads2svd.py diff', description="Registers and fields added (+), removed (-) and changed (~) from the first core to the second, on resolved cores (out/cores.snap or out/*.xml).")
+diffparser.add_argument('core'              , nargs='+', help="Core names (file names without .xml).")
+diffparser.add_argument('-o', '--out'       , default="./out/", help="Output directory of the resolving run (defaults to 'out').")
+diffparser.add_argument('-a', '--all'       , action='store_true', help="Compare the core with every other one of out/registers.hash (ads2svd.py --index), with -d on the resolved cores.")
+diffparser.add_argument('-d', '--descriptions', action='store_true', help="Also compare the descriptions.")
+
+mergeparser = argparse.ArgumentParser(prog='ads2svd.py merge', description="Put the output directories of the --shard runs together : per core files are copied, the logs, manifest, index and snapshot are combined.")
+mergeparser.add_argument('shard'       , nargs='+', help="Output directories of the shards.")
+mergeparser.add_argument('-o', '--out' , default="./out/", help="Merged output directory (defaults to 'out').")
+
+serveparser = argparse.ArgumentParser(prog='ads2svd.py serve', description="Serve the cores over http, resolved and emitted on the first request then kept in a LRU (GET /cores for the list, /cores/X.xml, /cores/X.svd or /cores/X/<reg_filter>.svd, /cores/X.json, /cores/X.h or /cores/X/<reg_filter>.h).")
+serveparser.add_argument('-c', '--configdb'  , required=True, help="Base path for the DS configdb folder.")
+serveparser.add_argument('-p', '--port'      , type=int, default=8000, help="Port (defaults to 8000, 0 picks a free one).")
+serveparser.add_argument('-b', '--bind'      , default='127.0.0.1', help="Address to listen on (defaults to 127.0.0.1).")
+serveparser.add_argument('-j', '--jobs'      , type=int, default=0, help="Worker processes for the cold requests (defaults to 0 : one per cpu).")
+serveparser.add_argument('--cache-size'      , type=int, default=256, help="Size of the LRU of results in MB (defaults to 256).")
+serveparser.add_argument('--derive'          , action='store_true', help="Serve the svds with derivedFrom, like --svd --derive.")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ['query']:
+        sys.exit(query(queryparser.parse_args(sys.argv[2:])))
+    if sys.argv[1:2] == ['diff']:
+        sys.exit(diff_cores(diffparser.parse_args(sys.argv[2:])))
+    if sys.argv[1:2] == ['serve']:
+        sys.exit(serve(serveparser.parse_args(sys.argv[2:])))
+    if sys.argv[1:2] == ['merge']:
+        sys.exit(merge_shards(mergeparser.parse_args(sys.argv[2:])))
+
+    args = argparser.parse_args()
+
+    if(args.infile):
+        args.all = False
+     
+    r = Resolver(**vars(args))
+    prepare_out(r)
+    if args.watch:
+        changes = watch_changes(r)
+        
+    xmls_cores = []
+    if(args.all):
+        xmls_cores = get_all(r)
+    elif args.infile:
+        if '-' in args.infile:
+            args.infile = [x for x in args.infile if x != '-'] + sys.stdin.read().split()
+        xmls_cores = shard_cores(r, args.infile)
+        loadxmls(r, xmls_cores)
+    else:
+        print("No action selected")
 
+    update_snapshot(r)
 
-if(args.infile):
-    args.all = False
- 
-update_config(args)
-build_schema_wrapper()
-    
-if(args.all):
-    get_all()
-elif args.infile:
-    loadxml(args.infile)
-else:
-    print("No action selected")
+    if args.watch:
+        r.config["jobs"] = 1
+        try:
+            watch(r, xmls_cores, args.all, changes)
+        except KeyboardInterrupt:
+            pass
 
+    if args.check and check_svds(r.config["out_dir"], xmls_cores, args.check):
+        sys.exit(1)
+    if r.failed_cores:
+        sys.exit(1)
@@ -0,0 +1,143 @@
+#! /usr/bin/env python3
+
+# benchmark of the ads2svd.py resolve path (loadxmls, the same code get_all uses)
+# over the in/Cores corpus. Every run is a fresh process so the peak rss of a
+# scenario is its own; "cold" times the first pass (empty include cache),
+# "warm" runs the cores once untimed then times a second pass in the same process.
+
+import os
+import sys
+import re
+import glob
+import json
+import time
+import argparse
+import tempfile
+import resource
+import statistics
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+href = re.compile(r'href="([^"#]+)')
+virt = re.compile(r'Registers/System/ARMv8[^/]*/[^/]*_Virt\.xml$')
+
+def include_graph(path, seen=None):
+    # cheap href scan, only used to pick the scenario cores
+    seen = set() if seen is None else seen
+    if path in seen or not os.path.isfile(path):
+        return seen
+    seen.add(path)
+    with open(path, errors='replace') as f:
+        for h in href.findall(f.read()):
+            include_graph(os.path.normpath(os.path.join(os.path.dirname(path), h)), seen)
+    return seen
+
+def scenarios(configdb):
+    cores = sorted(glob.glob(os.path.join(configdb, "Cores", "*.xml")))
+    virts = [c for c in cores if any(virt.search(d.replace(os.path.sep, '/')) for d in include_graph(c))]
+    single = [c for c in cores if c.endswith(os.path.sep + "Cortex-M4.xml")] or cores[:1]
+    res = {}
+    for name, sel in (("single", single), ("virt", virts), ("all", cores)):
+        res[name + "_cold"] = sel
+        res[name + "_warm"] = sel
+    return res
+
+def child(args):
+    # runs in its own process : python3 bench.py --child scenario ...
+    sys.path.insert(0, here)
+    import ads2svd
+    cores = json.loads(sys.stdin.read())
+    with tempfile.TemporaryDirectory() as out:
+        cli = ['-c', args.configdb, '-o', out, '--validate', args.validate, '-i'] + cores
+        if args.svd:
+            cli.append('--svd')
+        if args.max_memory:
+            cli += ['--max-memory', str(args.max_memory)]
+        resolver = ads2svd.Resolver(**vars(ads2svd.argparser.parse_args(cli)))
+        ads2svd.prepare_out(resolver)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        t = time.perf_counter()
+        if args.validate != 'off':
+            ads2svd.build_schema_wrapper(resolver)
+        schema = time.perf_counter() - t
+        if args.child.endswith("_warm"):
+            ads2svd.loadxmls(resolver, cores)
+        t = time.perf_counter()
+        ads2svd.loadxmls(resolver, cores)
+        wall = time.perf_counter() - t
+        sys.stdout = stdout
+    # ru_maxrss is in kB on linux
+    print(json.dumps({"schema" : schema, "wall" : wall, "cores" : len(cores),
+                      "rss_kb" : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+def run(args, name, cores):
+    runs = []
+    for _ in range(args.repeat):
+        cmd = [sys.executable, os.path.join(here, "bench.py"), '-c', args.configdb, '--child', name]
+        if args.svd:
+            cmd.append('--svd')
+        cmd += ['--validate', args.validate]
+        if args.max_memory:
+            cmd += ['--max-memory', str(args.max_memory)]
+        res = subprocess.run(cmd, input=json.dumps(cores), stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        runs.append(json.loads(res.stdout.splitlines()[-1]))
+    walls = [r["wall"] for r in runs]
+    return {"cores" : len(cores), "repeat" : len(runs),
+            "wall_min" : min(walls), "wall_median" : statistics.median(walls),
+            "schema_median" : statistics.median(r["schema"] for r in runs),
+            "rss_kb" : max(r["rss_kb"] for r in runs)}
+
+def compare(results, baseline, threshold):
+    # a scenario regresses when its median wall time or its peak rss grew past the threshold
+    nbad = 0
+    for name, res in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print('%-12s no baseline' % name)
+            continue
+        for k in ("wall_median", "rss_kb"):
+            ratio = res[k] / base[k] if base[k] else 1.0
+            status = 'ok'
+            if ratio > 1 + threshold:
+                status = 'REGRESSION'
+                nbad += 1
+            print('%-12s %-12s %12.3f -> %12.3f (%+.1f%%) %s' % (name, k, base[k], res[k], (ratio - 1) * 100, status))
+    return nbad
+
+argparser = argparse.ArgumentParser()
+argparser.add_argument('-c', '--configdb', default=os.path.join(here, "in"), help="Base path for the DS configdb folder (defaults to ./in).")
+argparser.add_argument('-s', '--scenario', nargs='+', action='extend', default=[], help="Only run these scenarios (single_cold, single_warm, virt_cold, virt_warm, all_cold, all_warm).")
+argparser.add_argument('-r', '--repeat'  , type=int, default=3, help="Runs per scenario, the median is reported (defaults to 3).")
+argparser.add_argument('--svd'           , action='store_true', help="Also time the python svd emitter.")
+argparser.add_argument('--validate'      , choices=('off', 'once', 'full'), default='once', help="ads2svd.py --validate policy to time (defaults to once).")
+argparser.add_argument('--max-memory'    , type=int, default=None, help="ads2svd.py --max-memory budget in MB to time.")
+argparser.add_argument('--save'          , default=None, help="Write the results to this json file (a baseline for --baseline).")
+argparser.add_argument('--baseline'      , default=None, help="Compare with this saved result, exit 1 on a regression.")
+argparser.add_argument('--threshold'     , type=float, default=0.10, help="Allowed slowdown / rss growth over the baseline (defaults to 0.10 : 10%%).")
+argparser.add_argument('--child'         , default=None, help=argparse.SUPPRESS)
+
+if __name__ == "__main__":
+    args = argparser.parse_args()
+    args.configdb = os.path.abspath(args.configdb)
+    if args.child:
+        child(args)
+        sys.exit(0)
+
+    results = {}
+    for name, cores in scenarios(args.configdb).items():
+        if args.scenario and name not in args.scenario:
+            continue
+        results[name] = run(args, name, cores)
+        r = results[name]
+        print('%-12s %3d cores  wall %8.3fs (min %8.3fs)  schema %6.3fs  rss %8d kB' % (
+            name, r["cores"], r["wall_median"], r["wall_min"], r["schema_median"], r["rss_kb"]))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
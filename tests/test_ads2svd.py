@@ -0,0 +1,706 @@
+#! /usr/bin/env python3
+# python3 -m pytest tests (or python3 -m unittest discover tests) from the top directory
+
+import copy
+import io
+import json
+import mmap
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import urllib.error
+import urllib.request
+
+from lxml import etree
+
+here = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, here)
+import ads2svd
+
+CONFIGDB = os.path.join(here, 'in')
+CORES = ['Cortex-M0', 'Cortex-M4', 'Cortex-M7']
+
+def run(*args):
+    return subprocess.run([sys.executable, os.path.join(here, 'ads2svd.py')] + list(args),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+
+class OutDir(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp)
+
+EMIT = '''<?xml version="1.0"?>
+<core_definition xmlns="http://www.arm.com/core_definition" xmlns:cr="http://www.arm.com/core_reg" xmlns:tcf="http://com.arm.targetconfigurationeditor">
+    <name>Cortex-M4</name>
+    <series>M</series>
+    <cr:register_list name="Core">
+        <cr:register name="CONTROL" size="4" access="RW">
+            <cr:gui_name>CONTROL</cr:gui_name>
+            <cr:bitField name="nPRIV" enumerationId="priv"><cr:definition>[0]</cr:definition></cr:bitField>
+            <cr:bitField name="SPSEL"><cr:definition>[5:2]</cr:definition></cr:bitField>
+        </cr:register>
+        <cr:register name="R_HIDDEN" size="4"><cr:gui_name>R_HIDDEN</cr:gui_name></cr:register>
+        <tcf:enumeration name="priv" values="privileged=0,unprivileged=1"/>
+    </cr:register_list>
+    <cr:register_list name="System">
+        <cr:peripheral name="SysTick">
+            <cr:description>System timer</cr:description>
+            <cr:register name="SYST_CSR" size="4" access="RW" offset="0xE000E010"/>
+            <cr:register name="SYST_RVR" size="4" access="RO" offset="0xE000E014"/>
+        </cr:peripheral>
+    </cr:register_list>
+</core_definition>
+'''
+
+def make_configdb(tmp, cores, files=()):
+    # a configdb of its own : {core name : xml}, (path under Cores/, xml)
+    db = os.path.join(tmp, 'db')
+    os.makedirs(os.path.join(db, 'Schemas'))
+    for path, data in [(name + '.xml', xml) for name, xml in cores.items()] + list(files):
+        path = os.path.join(db, 'Cores', path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(data)
+    return db
+
+class SvdTest(OutDir):
+    def test_emit(self):
+        db = make_configdb(self.tmp, {'Emit' : EMIT})
+        out = os.path.join(self.tmp, 'out')
+        res = run('-c', db, '-o', out, '--validate', 'off', '--svd', '-i', os.path.join(db, 'Cores', 'Emit.xml'))
+        self.assertEqual(res.returncode, 0, res.stderr)
+        device = etree.parse(os.path.join(out, 'Emit.svd')).getroot()
+        self.assertEqual([device.findtext(t) for t in ('name', 'series', 'cpu/name', 'width')], ['Cortex_M4', 'M', 'CM4', '32'])
+        core, systick = device.findall('peripherals/peripheral')
+        # the register list is a peripheral without addresses, registers with a _ in gui_name are left out
+        self.assertEqual(core.findtext('name'), 'Core')
+        self.assertEqual([r.findtext('name') for r in core.iter('register')], ['CONTROL'])
+        self.assertEqual([(f.findtext('name'), f.findtext('bitOffset'), f.findtext('bitWidth')) for f in core.iter('field')],
+                         [('nPRIV', '0', '1'), ('SPSEL', '2', '4')])
+        self.assertEqual([(v.findtext('name'), v.findtext('value')) for v in core.iter('enumeratedValue')],
+                         [('privileged', '0'), ('unprivileged', '1')])
+        # the base address is the lowest offset, the registers are relative to it
+        self.assertEqual([systick.findtext(t) for t in ('name', 'description', 'baseAddress', 'addressBlock/size')],
+                         ['SysTick', 'System timer', '0xE000E010', '0x40'])
+        self.assertEqual([(r.findtext('name'), r.findtext('size'), r.findtext('access'), r.findtext('addressOffset')) for r in systick.iter('register')],
+                         [('SYST_CSR', '0x20', 'read-write', '0x0'), ('SYST_RVR', '0x20', 'read-only', '0x4')])
+
+    def test_numbers(self):
+        # the stylesheet quirks the emitter keeps
+        self.assertEqual([ads2svd.dec2hex(v) for v in (0, 15, 16, 17, 256)], ['0x0', '0xF', '0x0', '0x11', '0x00'])
+        self.assertEqual(ads2svd.hex2dec('0xE000E010'), 0xE000E010)
+        self.assertEqual([ads2svd.double_str(v) for v in (32.0, 0.5, 1e7)], ['32', '0.5', '1.0E7'])
+        self.assertEqual(ads2svd.map_cpu_name('Cortex-A53'), 'CA53')
+
+CORE = '''<?xml version="1.0"?>
+<core_definition xmlns="http://www.arm.com/core_definition" xmlns:cr="http://www.arm.com/core_reg" xmlns:xi="http://www.w3.org/2001/XInclude">
+    <name>Test</name>
+    <series>M</series>
+    <cr:register_list name="Core">
+        <xi:include href="Registers/regs.xml" xpointer="%s"/>
+    </cr:register_list>
+</core_definition>
+'''
+REGS = '''<?xml version="1.0"?>
+<cr:registers xmlns:cr="http://www.arm.com/core_reg">
+    <cr:register name="R0" size="4" access="RW"/>
+</cr:registers>
+'''
+POINTER = 'xmlns(cr=http://www.arm.com/core_reg)xpointer(//cr:register)'
+
+class IncludeTest(OutDir):
+    def configdb(self, xpointer, regs_dir):
+        return make_configdb(self.tmp, {'Test' : CORE % xpointer}, [(os.path.join(regs_dir, 'regs.xml'), REGS)])
+
+    def resolve(self, db, *args):
+        out = os.path.join(self.tmp, 'out')
+        res = run('-c', db, '-o', out, '--validate', 'off', '-i', os.path.join(db, 'Cores', 'Test.xml'), *args)
+        with open(os.path.join(out, 'Test.xml')) as f:
+            resolved = f.read()
+        with open(os.path.join(out, 'xinclude_error.log')) as f:
+            errors = f.readlines()
+        return res, out, resolved, errors
+
+    def test_resolved(self):
+        res, _, resolved, errors = self.resolve(self.configdb(POINTER, 'Registers'))
+        self.assertEqual(res.returncode, 0, res.stderr)
+        self.assertIn('name="R0"', resolved)
+        self.assertEqual(errors, [])
+
+    def test_bad_xpointer(self):
+        for xpointer in ('xmlns(cr=http://www.arm.com/core_reg)xpointer(//nope:register)',
+                         'xmlns(cr=http://www.arm.com/core_reg)xpointer(//cr:register[)'):
+            res, _, resolved, errors = self.resolve(self.configdb(xpointer, 'Registers'))
+            shutil.rmtree(os.path.join(self.tmp, 'db'))
+            self.assertEqual(res.returncode, 0, res.stderr)
+            self.assertIn('FAIL : 1', resolved)
+            self.assertEqual(len(errors), 1)
+            self.assertIn('XPointer', errors[0])
+
+    def test_missing(self):
+        res, _, resolved, errors = self.resolve(self.configdb(POINTER, 'Moved'))
+        self.assertEqual(res.returncode, 0, res.stderr)
+        self.assertNotIn('name="R0"', resolved)
+        self.assertEqual(len(errors), 1)
+
+    def test_repair(self):
+        db = self.configdb(POINTER, 'Moved')
+        res, out, resolved, errors = self.resolve(db)
+        self.assertNotIn('fallback', errors[0])
+        res, out, resolved, errors = self.resolve(db, '--repair')
+        self.assertEqual(res.returncode, 0, res.stderr)
+        self.assertIn('name="R0"', resolved)
+        self.assertEqual(errors, [])
+        with open(os.path.join(out, 'include_repairs.log')) as f:
+            self.assertEqual(f.readlines(), ['REPAIRED;file="/Cores/Registers/regs.xml";to="/Cores/Moved/regs.xml";core="/Cores/Test.xml"\n'])
+        with open(os.path.join(out, 'Test.d')) as f:
+            self.assertIn(os.path.relpath(os.path.join(db, 'Cores', 'Moved', 'regs.xml')), f.read())
+
+def core_files(names):
+    return [os.path.join(CONFIGDB, 'Cores', n + '.xml') for n in names]
+
+class JobsTest(OutDir):
+    def test_failed_core(self):
+        # a core failing in a worker is reported, the others are still done
+        bad = os.path.join(self.tmp, 'Bad.xml')
+        with open(bad, 'w') as f:
+            f.write('<core_definition')
+        for jobs in ('1', '2'):
+            out = os.path.join(self.tmp, 'out' + jobs)
+            res = run('-c', CONFIGDB, '-o', out, '--validate', 'off', '-j', jobs, '-i', bad, *core_files(CORES[:2]))
+            self.assertEqual(res.returncode, 1)
+            self.assertIn('Bad.xml : resolve failed : XMLSyntaxError', res.stderr)
+            with open(os.path.join(out, 'manifest.json')) as f:
+                self.assertEqual(sorted(json.load(f)), [c + '.xml' for c in CORES[:2]])
+
+class IndexTest(OutDir):
+    def setUp(self):
+        OutDir.setUp(self)
+        ads2svd.Resolver(CONFIGDB, out=self.tmp, validate='off', index=True).build(core_files(CORES))
+        with open(os.path.join(self.tmp, 'registers.idx'), 'rb') as f:
+            self.lines = [l.decode().rstrip('\n').split('\t') for l in f]
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.addCleanup(self.map.close)
+
+    def test_lookup(self):
+        # the bisection finds what a scan of the whole file does, first, middle and last keys
+        self.assertTrue(self.lines)
+        keys = [self.lines[0][0], self.lines[len(self.lines) // 2][0], self.lines[-1][0]]
+        for key in keys:
+            self.assertEqual(list(ads2svd.index_lookup(self.map, key.encode())), [l[1:] for l in self.lines if l[0] == key])
+        prefix = keys[1][:3]
+        self.assertEqual(list(ads2svd.index_lookup(self.map, prefix.encode(), True)), [l[1:] for l in self.lines if l[0].startswith(prefix)])
+        self.assertEqual(list(ads2svd.index_lookup(self.map, b'\x7fno such register')), [])
+
+    def test_query(self):
+        name = next(l for l in self.lines if l[1] == 'name')
+        res = run('query', name[2].upper(), '-o', self.tmp, '-k', 'name')
+        self.assertEqual(res.returncode, 0)
+        self.assertIn('\t'.join(name[3:8]), res.stdout)
+        self.assertEqual(run('query', '-o', self.tmp, 'no_such_register').returncode, 1)
+
+def expand(device):
+    # --derive undone : every derivedFrom gets the content of its source back
+    def fill(el, src, keep):
+        own = dict((c.tag, c) for c in el)
+        for c in list(el):
+            el.remove(c)
+        for c in src:
+            el.append(own[c.tag] if c.tag in keep and c.tag in own else copy.deepcopy(c))
+        del el.attrib['derivedFrom']
+    peripherals = dict((p.findtext('name'), p) for p in device.iter('peripheral'))
+    for p in device.iter('peripheral'):
+        if p.get('derivedFrom'):
+            fill(p, peripherals[p.get('derivedFrom')], ('name', 'description', 'baseAddress'))
+    for p in device.iter('peripheral'):
+        registers = dict((r.findtext('name'), r) for r in p.iter('register'))
+        for r in p.iter('register'):
+            if r.get('derivedFrom'):
+                fill(r, registers[r.get('derivedFrom')], ('name', 'addressOffset'))
+    values = dict((v.findtext('name'), v) for v in device.iter('enumeratedValues') if v.find('name') is not None)
+    for v in device.iter('enumeratedValues'):
+        if v.get('derivedFrom'):
+            fill(v, values[v.get('derivedFrom')], ())
+    for v in device.iter('enumeratedValues'):
+        if v.find('name') is not None:
+            v.remove(v.find('name'))
+    return device
+
+class DeriveTest(unittest.TestCase):
+    def test_expand(self):
+        plain = ads2svd.Resolver(CONFIGDB, validate='off')
+        derived = ads2svd.Resolver(CONFIGDB, validate='off', derive=True)
+        for core in CORES:
+            ref = plain.svd(core)
+            devices = derived.svd(core)
+            self.assertEqual(sorted(devices), sorted(ref))
+            for name, device in devices.items():
+                self.assertIn('derivedFrom', etree.tostring(device).decode(), name)
+                self.assertIsNone(ads2svd.svd_diff(expand(device), ref[name]), name)
+
+    def test_schema(self):
+        # the derivedFrom values are identifiers the svd schema accepts
+        derived = ads2svd.Resolver(CONFIGDB, validate='off', derive=True)
+        ident = ads2svd.re.compile(r'^[_A-Za-z][_A-Za-z0-9]*$')
+        for core in CORES:
+            for device in derived.svd(core).values():
+                for el in device.iter():
+                    if el.get('derivedFrom') is not None:
+                        self.assertRegex(el.get('derivedFrom'), ident)
+
+class MergeTest(OutDir):
+    def build(self, out, *args):
+        res = run('-c', CONFIGDB, '-o', os.path.join(self.tmp, out), '--validate', 'off', '--index', '-i', *(core_files(CORES) + list(args)))
+        self.assertEqual(res.returncode, 0, res.stderr)
+        return os.path.join(self.tmp, out)
+
+    def files(self, d):
+        res = {}
+        for name in sorted(os.listdir(d)):
+            if name not in ('manifest.json', 'validation.log') and not name.endswith('.d'):
+                with open(os.path.join(d, name), 'rb') as f:
+                    res[name] = f.read()
+        return res
+
+    def test_merge(self):
+        single = self.build('single')
+        shards = [self.build('s1', '--shard', '1/2'), self.build('s2', '--shard', '2/2')]
+        self.assertTrue(all(os.listdir(s) for s in shards))
+        out = os.path.join(self.tmp, 'out')
+        res = run('merge', '-o', out, *shards)
+        self.assertEqual(res.returncode, 0, res.stderr)
+        self.assertEqual(self.files(out), self.files(single))
+        with open(os.path.join(out, 'manifest.json')) as f, open(os.path.join(single, 'manifest.json')) as g:
+            self.assertEqual(json.load(f), json.load(g))
+        # a shard rebuilt with more outputs merges over the earlier merge
+        self.build('s1', '--shard', '1/2', '--svd')
+        res = run('merge', '-o', out, *shards)
+        self.assertEqual(res.returncode, 0, res.stderr)
+
+    def test_conflict(self):
+        shards = [self.build('s1', '--shard', '1/2'), self.build('s2')]
+        core = next(n for n in os.listdir(shards[0]) if n.endswith('.xml'))
+        with open(os.path.join(shards[1], core), 'a') as f:
+            f.write('<!-- changed -->\n')
+        out = os.path.join(self.tmp, 'out')
+        res = run('merge', '-o', out, *shards)
+        self.assertEqual(res.returncode, 1)
+        self.assertIn('differ', res.stderr)
+        # nothing is written before every shard is checked
+        self.assertEqual(os.listdir(out), [])
+
+class StaleTest(OutDir):
+    def setUp(self):
+        OutDir.setUp(self)
+        self.db = make_configdb(self.tmp, {'A' : CORE % POINTER, 'B' : EMIT}, [('Registers/regs.xml', REGS)])
+        self.out = os.path.join(self.tmp, 'out')
+
+    def redone(self, *args):
+        # the cores the run resolved, by name
+        res = run('-c', self.db, '-o', self.out, '--validate', 'off', '--stale', '-i',
+                  *[os.path.join(self.db, 'Cores', c + '.xml') for c in ('A', 'B')] + list(args))
+        self.assertEqual(res.returncode, 0, res.stderr)
+        return [os.path.basename(l)[:-4] for l in res.stdout.split()]
+
+    def test_outputs(self):
+        self.assertEqual(self.redone(), ['A', 'B'])
+        self.assertEqual(self.redone(), [])
+        # outputs the first run did not make
+        self.assertEqual(self.redone('--svd', '--header', '--index'), ['A', 'B'])
+        for name in ('A.svd', 'B.h', 'registers.idx'):
+            self.assertTrue(os.path.isfile(os.path.join(self.out, name)), name)
+        self.assertEqual(self.redone('--svd', '--header', '--index'), [])
+        self.assertEqual(self.redone('--svd'), [])
+        self.assertEqual(self.redone('--svd', '--derive'), ['A', 'B'])
+        # a deleted output, and a deleted index with nothing else to redo
+        os.remove(os.path.join(self.out, 'B.svd'))
+        self.assertEqual(self.redone('--svd', '--derive'), ['B'])
+        os.remove(os.path.join(self.out, 'registers.idx'))
+        self.assertEqual(self.redone('--index'), ['A', 'B'])
+        self.assertTrue(os.path.isfile(os.path.join(self.out, 'registers.idx')))
+
+    def test_include_changed(self):
+        self.assertEqual(self.redone(), ['A', 'B'])
+        with open(os.path.join(self.db, 'Cores', 'Registers', 'regs.xml'), 'w') as f:
+            f.write(REGS.replace('R0', 'R1'))
+        self.assertEqual(self.redone(), ['A'])
+        with open(os.path.join(self.out, 'manifest.json')) as f:
+            manifest = json.load(f)
+        self.assertEqual(sorted(manifest['A.xml']['deps']), [os.path.join('Cores', 'A.xml'), os.path.join('Cores', 'Registers', 'regs.xml')])
+        self.assertEqual(manifest['A.xml']['outputs'], ['A.d', 'A.xml'])
+
+class WatchTest(OutDir):
+    def setUp(self):
+        OutDir.setUp(self)
+        # A has a bad xpointer, B includes a missing file
+        self.db = make_configdb(self.tmp, {'A' : CORE % POINTER.replace('cr:', 'nope:'),
+                                           'B' : CORE.replace('regs.xml', 'gone.xml') % POINTER}, [('Registers/regs.xml', REGS)])
+        self.out = os.path.join(self.tmp, 'out')
+
+    def log(self, name):
+        with open(os.path.join(self.out, name)) as f:
+            return f.readlines()
+
+    def test_logs(self):
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        proc = subprocess.Popen([sys.executable, os.path.join(here, 'ads2svd.py'), '-c', self.db, '-o', self.out, '--validate', 'off', '-a', '--watch'],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, env=env)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.kill)
+        def wait_for(text):
+            for line in proc.stdout:
+                if text in line:
+                    return
+            self.fail('no %r' % text)
+        wait_for('watching')
+        self.assertEqual([l.split('file="')[1].split('"')[0] for l in self.log('xinclude_error.log')], ['/Cores/A.xml', '/Cores/B.xml'])
+        with open(os.path.join(self.db, 'Cores', 'A.xml'), 'w') as f:
+            f.write(CORE % POINTER)
+        wait_for('redone')
+        # only A was redone, its error is gone and the one of B stays
+        errors = self.log('xinclude_error.log')
+        self.assertEqual(len(errors), 1)
+        self.assertIn('/Cores/B.xml', errors[0])
+        with open(os.path.join(self.out, 'A.xml')) as f:
+            self.assertIn('name="R0"', f.read())
+
+    def test_poll_from_start(self):
+        # the mtimes are taken when the watch is set up, not on the first wait
+        path = os.path.join(self.db, 'Cores', 'A.xml')
+        changes = ads2svd.poll_changes(self.db)
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(next(changes), set([path]))
+
+FILTERED = '''<?xml version="1.0"?>
+<core_definition xmlns="http://www.arm.com/core_definition" xmlns:cr="http://www.arm.com/core_reg">
+    <name>Filtered</name>
+    <reg_filter id="F64" gui_name="AArch64"/>
+    <reg_filter id="F32" gui_name="AArch32"/>
+    <cr:register_list filter="F32" name="Core"><cr:register name="R0" size="4"/></cr:register_list>
+    <cr:register_list name="Debug">
+        <cr:register name="DBG" size="4"/>
+        <cr:register_list filter="F64" name="Inner"><cr:register name="X1" size="8"/></cr:register_list>
+    </cr:register_list>
+    <cr:register_list filter="F64" name="Core">
+        <cr:register name="X0" size="8"/>
+        <cr:register_list filter="F32" name="Odd"/>
+    </cr:register_list>
+    <cr:register_list filter="F64" name="Empty"/>
+</core_definition>
+'''
+
+class SnapshotTest(OutDir):
+    def setUp(self):
+        OutDir.setUp(self)
+        db = make_configdb(self.tmp, {'Filtered' : FILTERED, 'Emit' : EMIT})
+        self.out = os.path.join(self.tmp, 'out')
+        res = run('-c', db, '-o', self.out, '--validate', 'off', '-a', '--snapshot')
+        self.assertEqual(res.returncode, 0, res.stderr)
+        self.snapshot = ads2svd.Snapshot(os.path.join(self.out, 'cores.snap'))
+        self.addCleanup(self.snapshot.close)
+
+    def registers(self, core, reg_filter=None):
+        return [(r.getparent().get('name'), r.get('name')) for r in self.snapshot.load(core, reg_filter).iter(ads2svd.CR + 'register')]
+
+    def test_index(self):
+        self.assertEqual(self.snapshot.cores(), ['Emit', 'Filtered'])
+        self.assertEqual(self.snapshot.filters('Filtered'), {'AArch64' : 'F64', 'AArch32' : 'F32'})
+        # the outermost register lists of a filter are stored apart from the skeleton
+        self.assertEqual([s[0] for s in self.snapshot.index['Filtered']['slices']], ['F32', 'F64', 'F64', 'F64'])
+        self.assertEqual(self.snapshot.index['Emit']['slices'], [])
+
+    def test_load(self):
+        with open(os.path.join(self.out, 'Filtered.xml'), 'rb') as f:
+            whole = etree.fromstring(f.read(), etree.XMLParser(remove_blank_text=True))
+        self.assertEqual(etree.tostring(self.snapshot.load('Filtered').getroot(), method='c14n'), etree.tostring(whole, method='c14n'))
+        self.assertEqual(self.registers('Filtered', 'AArch64'), [('Debug', 'DBG'), ('Inner', 'X1'), ('Core', 'X0')])
+        self.assertEqual(self.registers('Filtered', 'F32'), [('Core', 'R0'), ('Debug', 'DBG')])
+        self.assertEqual([l.get('name') for l in self.snapshot.load('Filtered', 'AArch64').iter(ads2svd.CR + 'register_list')],
+                         ['Debug', 'Inner', 'Core', 'Empty'])
+        self.assertEqual(self.registers('Emit'), [('Core', 'CONTROL'), ('Core', 'R_HIDDEN'), ('SysTick', 'SYST_CSR'), ('SysTick', 'SYST_RVR')])
+        self.assertRaises(KeyError, self.snapshot.load, 'Filtered', 'Thumb')
+
+def model_data(core):
+    # what the model holds, in the same shape whatever it was built from
+    return json.loads(json.dumps(ads2svd.core_json(core)))
+
+class ExportTest(OutDir):
+    def test_round_trip(self):
+        r = ads2svd.Resolver(CONFIGDB, out=self.tmp, validate='off', export=['json', 'binary'])
+        r.build(core_files(['Cortex-M4']))
+        ref = model_data(r.model('Cortex-M4'))
+        for name in ('Cortex-M4.min.json', 'Cortex-M4.regs'):
+            self.assertEqual(model_data(ads2svd.load_export(os.path.join(self.tmp, name))), ref, name)
+
+    def test_missing(self):
+        with self.assertRaises(FileNotFoundError):
+            ads2svd.load_export(os.path.join(self.tmp, 'Cortex-M4.regs'))
+
+
+    def test_reg_filter(self):
+        db = make_configdb(self.tmp, {'Filtered' : FILTERED})
+        r = ads2svd.Resolver(db, out=self.tmp, validate='off', export=['binary'])
+        r.build([r.core_path('Filtered')])
+        model = r.model('Filtered')
+        for reg_filter in ('AArch64', 'F32'):
+            core = ads2svd.load_export(os.path.join(self.tmp, 'Filtered.regs'), reg_filter)
+            self.assertEqual(core.filters, model.filters)
+            self.assertEqual([l.name for l in core.register_lists], [l.name for l in model.register_lists if l.filter in (None, model.filters.get(reg_filter, reg_filter))])
+            self.assertEqual([reg.name for reg in core.registers()], [reg.name for reg in model.registers(reg_filter)])
+        self.assertRaises(KeyError, ads2svd.load_export, os.path.join(self.tmp, 'Filtered.regs'), 'Thumb')
+
+class StatsTest(OutDir):
+    def test_stats(self):
+        db = make_configdb(self.tmp, {'A' : CORE % POINTER, 'B' : CORE.replace('regs.xml', 'gone.xml') % POINTER}, [('Registers/regs.xml', REGS)])
+        for jobs in ('1', '2'):
+            stats = os.path.join(self.tmp, 'stats%s.json' % jobs)
+            res = run('-c', db, '-o', os.path.join(self.tmp, 'out'), '--validate', 'off', '--svd', '-j', jobs, '--stats', stats, '-a')
+            self.assertEqual(res.returncode, 0, res.stderr)
+            with open(stats) as f:
+                lines = [json.loads(l) for l in f]
+            # one line per core in input order, then the summary
+            a, b, summary = lines
+            self.assertEqual((a["core"], b["core"]), ('A.xml', 'B.xml'))
+            self.assertEqual([(c["includes"], c["includes_failed"]) for c in (a, b)], [(1, 0), (1, 1)])
+            self.assertTrue(a["bytes_in"] > 0 and a["bytes_out"] > 0 and a["svd"] > 0)
+            self.assertEqual([summary[k] for k in ("summary", "cores", "jobs", "includes", "includes_failed")], [True, 2, int(jobs), 2, 1])
+            self.assertEqual(summary["bytes_out"], a["bytes_out"] + b["bytes_out"])
+            self.assertEqual(sorted(summary["slowest"]), ['A.xml', 'B.xml'])
+
+SCHEMA = '''<?xml version="1.0"?>
+<xs:schema xmlns:xs="http://www.w3.org/2001/XMLSchema" targetNamespace="http://www.arm.com/core_definition" elementFormDefault="qualified">
+    <xs:element name="core_definition">
+        <xs:complexType>
+            <xs:sequence>
+                <xs:element name="name" type="xs:string"/>
+                <xs:any processContents="skip" minOccurs="0" maxOccurs="unbounded"/>
+            </xs:sequence>
+        </xs:complexType>
+    </xs:element>
+</xs:schema>
+'''
+
+class ValidateTest(OutDir):
+    def setUp(self):
+        OutDir.setUp(self)
+        # B has no name, both include regs.xml that the schema does not know
+        self.db = make_configdb(self.tmp, {'A' : CORE % POINTER, 'B' : (CORE % POINTER).replace('<name>Test</name>', '')}, [('Registers/regs.xml', REGS)])
+        with open(os.path.join(self.db, 'Schemas', 'core.xsd'), 'w') as f:
+            f.write(SCHEMA)
+        self.out = os.path.join(self.tmp, 'out')
+
+    def invalid(self, validate):
+        res = run('-c', self.db, '-o', self.out, '--validate', validate, '-a')
+        self.assertEqual(res.returncode, 0, res.stderr)
+        with open(os.path.join(self.out, 'validation.log')) as f:
+            return [l.split(';')[1] for l in f]
+
+    def test_once(self):
+        # every source file once, the include shared by both cores reported once
+        self.assertEqual(self.invalid('once'), ['file="/Cores/Registers/regs.xml"', 'file="/Cores/B.xml"'])
+        with open(os.path.join(self.out, 'validated.json')) as f:
+            cache = json.load(f)
+        self.assertEqual(len(cache["files"]), 3)
+        # the next run takes the results from the cache, the cores are still generated
+        self.assertEqual(self.invalid('once'), ['file="/Cores/Registers/regs.xml"', 'file="/Cores/B.xml"'])
+        self.assertTrue(os.path.isfile(os.path.join(self.out, 'B.xml')))
+        # a schema change drops it
+        with open(os.path.join(self.db, 'Schemas', 'core.xsd'), 'w') as f:
+            f.write(SCHEMA.replace('<xs:element name="name" type="xs:string"/>', ''))
+        self.assertEqual(self.invalid('once'), ['file="/Cores/Registers/regs.xml"'])
+
+    def test_full_and_off(self):
+        # the resolved document : regs.xml is no longer a document of its own
+        self.assertEqual(self.invalid('full'), ['file="/Cores/B.xml"'])
+        self.assertEqual(self.invalid('off'), [])
+
+class HeaderTest(OutDir):
+    def setUp(self):
+        OutDir.setUp(self)
+        wide = ('<cr:register name="X0" size="8"><cr:bitField name="HI"><cr:definition>[63:32]</cr:definition></cr:bitField>'
+                '<cr:bitField name="SPLIT"><cr:definition>[15:10][26:25]</cr:definition></cr:bitField></cr:register>')
+        db = make_configdb(self.tmp, {'Emit' : EMIT, 'Filtered' : FILTERED.replace('<cr:register name="X0" size="8"/>', wide)})
+        self.out = os.path.join(self.tmp, 'out')
+        res = run('-c', db, '-o', self.out, '--validate', 'off', '--header', '--json', '-a')
+        self.assertEqual(res.returncode, 0, res.stderr)
+
+    def defines(self, name):
+        with open(os.path.join(self.out, name)) as f:
+            return dict(l.split()[1:3] for l in f if l.startswith('#define ') and len(l.split()) > 2)
+
+    def test_defines(self):
+        # one header per reg_filter
+        self.assertEqual(sorted(f for f in os.listdir(self.out) if f.endswith('.h')), ['Emit.h', 'Filtered_AArch32.h', 'Filtered_AArch64.h'])
+        emit = self.defines('Emit.h')
+        self.assertEqual([emit[k] for k in ('CONTROL_NPRIV_Pos', 'CONTROL_SPSEL_Msk', 'CONTROL_NPRIV_UNPRIVILEGED', 'SYSTICK_BASE', 'SYSTICK_SYST_RVR_OFFSET')],
+                         ['0', '(0xFUL', '0x1UL', '0xE000E010UL', '0x4UL'])
+        # a mask past bit 31 is ULL, a split field only gets its mask
+        wide = self.defines('Filtered_AArch64.h')
+        self.assertEqual([wide.get(k) for k in ('X0_HI_Pos', 'X0_HI_Msk', 'X0_SPLIT_Pos', 'X0_SPLIT_Msk')], ['32', '(0xFFFFFFFFULL', None, '0x600FC00UL'])
+        self.assertNotIn('X0_HI_Pos', self.defines('Filtered_AArch32.h'))
+        with open(os.path.join(self.out, 'Filtered.json')) as f:
+            self.assertEqual([l["name"] for l in json.load(f)["register_lists"]], ['Core', 'Debug', 'Inner', 'Core', 'Odd', 'Empty'])
+
+    @unittest.skipUnless(shutil.which('cc'), 'no C compiler')
+    def test_compiles(self):
+        src = os.path.join(self.tmp, 'test.c')
+        with open(src, 'w') as f:
+            f.write('#include "Emit.h"\n#include "Filtered_AArch64.h"\n'
+                    '_Static_assert(X0_HI_Msk == 0xFFFFFFFF00000000ULL, "HI");\n'
+                    '_Static_assert(CONTROL_SPSEL_Msk == 0x3C, "SPSEL");\n')
+        res = subprocess.run(['cc', '-std=c11', '-Wall', '-Werror', '-fsyntax-only', '-I', self.out, src], stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(res.returncode, 0, res.stderr)
+
+class DiffTest(OutDir):
+    def setUp(self):
+        OutDir.setUp(self)
+        # B : a field and an access changed, a register renamed, a description added
+        b = (EMIT.replace('access="RO" offset="0xE000E014"', 'access="RW" offset="0xE000E014"')
+                 .replace('<cr:definition>[5:2]</cr:definition>', '<cr:definition>[1]</cr:definition>')
+                 .replace('"R_HIDDEN" size="4"><cr:gui_name>R_HIDDEN</cr:gui_name>', '"R_NEW" size="4"><cr:gui_name>R_NEW</cr:gui_name>')
+                 .replace('size="4" access="RW">', 'size="4" access="RW"><cr:description>changed</cr:description>', 1))
+        db = make_configdb(self.tmp, {'A' : EMIT, 'B' : b})
+        self.out = os.path.join(self.tmp, 'out')
+        res = run('-c', db, '-o', self.out, '--validate', 'off', '-a', '--index')
+        self.assertEqual(res.returncode, 0, res.stderr)
+
+    def diff(self, *args):
+        res = run('diff', '-o', self.out, *args)
+        self.assertEqual(res.stderr, '')
+        return res.returncode, res.stdout.splitlines()
+
+    def test_two_cores(self):
+        expected = ['+ //R_NEW', '- //R_HIDDEN', '~ //CONTROL : ~SPSEL', '~ /SysTick/SYST_RVR : access RO -> RW',
+                    '1 added, 1 removed, 2 changed, 1 identical']
+        self.assertEqual(self.diff('A', 'B'), (1, expected))
+        self.assertEqual(self.diff('A', 'A'), (0, ['0 added, 0 removed, 0 changed, 4 identical']))
+        # from the resolved cores : -d, or no registers.hash
+        self.assertEqual(self.diff('-d', 'A', 'B')[1][2], '~ //CONTROL : description None -> changed, ~SPSEL')
+        os.remove(os.path.join(self.out, 'registers.hash'))
+        self.assertEqual(self.diff('A', 'B'), (1, expected))
+
+    def test_all(self):
+        self.assertEqual(self.diff('-a', 'A'), (0, ['B                                +1     -1     ~2     =1']))
+        with open(os.path.join(self.out, 'registers.hash')) as f:
+            self.assertEqual([(e["core"], sorted(e)[1]) for e in map(json.loads, f)], [('A', 'registers'), ('A', 'details'), ('B', 'registers'), ('B', 'details')])
+
+class ServeTest(OutDir):
+    def setUp(self):
+        OutDir.setUp(self)
+        self.db = make_configdb(self.tmp, {'A' : CORE % POINTER, 'B' : CORE.replace('regs.xml', 'gone.xml') % POINTER, 'Filtered' : FILTERED},
+                                [('Registers/regs.xml', REGS)])
+        proc = subprocess.Popen([sys.executable, os.path.join(here, 'ads2svd.py'), 'serve', '-c', self.db, '-p', '0', '-j', '1'],
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        self.addCleanup(proc.wait)
+        self.addCleanup(proc.stdout.close)
+        self.addCleanup(proc.terminate)
+        # serving <configdb> on http://127.0.0.1:<port>/cores
+        self.url = proc.stdout.readline().split()[-1]
+
+    def get(self, path):
+        try:
+            with urllib.request.urlopen(self.url + path) as res:
+                return res.status, res.headers.get('X-Failed-Includes'), res.read().decode()
+        except urllib.error.HTTPError as err:
+            return err.code, None, err.read().decode()
+
+    def test_outputs(self):
+        self.assertEqual(self.get(''), (200, None, 'A\nB\nFiltered\n'))
+        status, failed, xml = self.get('/A.xml')
+        self.assertEqual((status, failed), (200, '0'))
+        self.assertIn('name="R0"', xml)
+        self.assertEqual(self.get('/B.xml')[:2], (200, '1'))
+        # the files the command line writes
+        out = os.path.join(self.tmp, 'out')
+        res = run('-c', self.db, '-o', out, '--validate', 'off', '--svd', '-i', os.path.join(self.db, 'Cores', 'Filtered.xml'))
+        self.assertEqual(res.returncode, 0, res.stderr)
+        status, _, svd = self.get('/Filtered/AArch64.svd')
+        self.assertEqual(status, 200)
+        with open(os.path.join(out, 'Filtered_AArch64.svd')) as f:
+            # but the generation time in <version>
+            self.assertEqual([l for l in svd.splitlines() if '<version>' not in l], [l for l in f.read().splitlines() if '<version>' not in l])
+        self.assertIn('ADS2SVD_FILTERED_AARCH32_H', self.get('/Filtered/AArch32.h')[2])
+        self.assertEqual(json.loads(self.get('/Filtered.json')[2])["name"], 'Filtered')
+        self.assertEqual(self.get('/Nope.svd')[0], 404)
+        self.assertEqual(self.get('/A.svg')[0], 404)
+        self.assertEqual(self.get('/Filtered/Thumb.h')[0], 404)
+
+    def test_changed_include(self):
+        self.assertIn('name="R0"', self.get('/A.xml')[2])
+        with open(os.path.join(self.db, 'Cores', 'Registers', 'regs.xml'), 'w') as f:
+            f.write(REGS.replace('R0', 'R1'))
+        self.assertIn('name="R1"', self.get('/A.xml')[2])
+
+class StoreTest(OutDir):
+    def setUp(self):
+        OutDir.setUp(self)
+        # A and Same resolve to the same bytes
+        self.db = make_configdb(self.tmp, {'A' : CORE % POINTER, 'Same' : CORE % POINTER, 'Emit' : EMIT}, [('Registers/regs.xml', REGS)])
+        self.out = os.path.join(self.tmp, 'out')
+
+    def build(self, out, *args):
+        res = run('-c', self.db, '-o', out, '--validate', 'off', '--export', 'binary', '-a', *args)
+        self.assertEqual(res.returncode, 0, res.stderr)
+        return res.stdout.split()
+
+    def objects(self):
+        return sorted(os.path.basename(o)[:-3] for d in os.listdir(os.path.join(self.out, 'objects')) for o in os.listdir(os.path.join(self.out, 'objects', d)))
+
+    def test_read_back(self):
+        plain = os.path.join(self.tmp, 'plain')
+        self.build(plain)
+        self.build(self.out, '--store', '--snapshot')
+        store = ads2svd.load_store(self.out)
+        self.assertEqual(sorted(store), ['A.regs', 'A.xml', 'Emit.regs', 'Emit.xml', 'Same.regs', 'Same.xml'])
+        # the .d files stay plain, make reads them
+        self.assertEqual([os.path.exists(os.path.join(self.out, name)) for name in ('A.xml', 'A.d')], [False, True])
+        # named by the sha1 of the content, identical outputs once
+        self.assertEqual(store['A.xml'], store['Same.xml'])
+        self.assertEqual(self.objects(), sorted(set(store.values())))
+        for name in ('A.xml', 'Emit.regs'):
+            data = ads2svd.read_output(os.path.join(self.out, name))
+            with open(os.path.join(plain, name), 'rb') as f:
+                self.assertEqual(data, f.read())
+            self.assertEqual(ads2svd.hashlib.sha1(data).hexdigest(), store[name])
+        self.assertEqual(model_data(ads2svd.load_export(os.path.join(self.out, 'Emit.regs'))), model_data(ads2svd.load_export(os.path.join(plain, 'Emit.regs'))))
+        snapshot = ads2svd.Snapshot(os.path.join(self.out, 'cores.snap'))
+        self.addCleanup(snapshot.close)
+        self.assertEqual(snapshot.cores(), ['A', 'Emit', 'Same'])
+        # --stale finds the outputs in the store
+        self.assertEqual(self.build(self.out, '--store', '--stale'), [])
+
+    def test_gc(self):
+        self.build(self.out, '--store')
+        before = ads2svd.load_store(self.out)
+        with open(os.path.join(self.db, 'Cores', 'Same.xml'), 'w') as f:
+            f.write(CORE.replace('Test', 'Other') % POINTER)
+        self.build(self.out, '--store')
+        store = ads2svd.load_store(self.out)
+        self.assertNotEqual(store['Same.xml'], before['Same.xml'])
+        self.assertEqual(store['A.xml'], before['A.xml'])
+        # only the objects a name maps to are kept
+        self.assertEqual(self.objects(), sorted(set(store.values())))
+
+class StreamTest(unittest.TestCase):
+    def test_same_bytes(self):
+        # the incremental writer gives what writing the whole device gives, empty
+        # <registers/> and <peripherals/> (a reg_filter without lists) included
+        cores = [EMIT, FILTERED.replace('<reg_filter id="F32"', '<reg_filter id="F16" gui_name="Thumb"/>\n    <reg_filter id="F32"')]
+        for xml in cores:
+            doc = etree.ElementTree(etree.fromstring(xml.encode(), etree.XMLParser(remove_blank_text=True)))
+            sources = [(path, rlists) for path, rlists in ads2svd.svd_sources(doc, 'X') if rlists is not None]
+            self.assertEqual(len(sources), 1 if xml is EMIT else 3)
+            for path, rlists in sources:
+                tree, streamed = io.BytesIO(), io.BytesIO()
+                etree.ElementTree(ads2svd.doparse(doc, rlists)).write(tree, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+                ads2svd.write_device(streamed, doc, rlists)
+                strip = lambda data: [l for l in data.splitlines() if b'<version>' not in l]
+                self.assertEqual(strip(streamed.getvalue()), strip(tree.getvalue()), path)
+                self.assertTrue(streamed.getvalue().endswith(b'</device>\n'))
+
+if __name__ == '__main__':
+    unittest.main()